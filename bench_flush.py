@@ -0,0 +1,203 @@
+"""
+buffer / flush 路徑的壓力測試 (本地 SQLite，不會碰 supabase)
+
+用 spotify_log/synthetic.py 產生的合成資料，直接跑真正的 should_update_db (含 50 筆門檻) -> insert_data_from_df，
+在不同的 logs 歷史筆數 (--history) 與每次抓到的筆數 (--batches) 下，量每個週期 (should_update_db + flush) 的延遲分位數、statement 數、記憶體峰值。
+延遲隨 batch 成長的 log-log 斜率 > 1.2 (超線性) 時會標出來。
+
+    python bench_flush.py
+    python bench_flush.py --history 0,100000,1000000 --batches 10,50,1000,10000 --rounds 5
+    python bench_flush.py --schema-mode surrogate
+    python bench_flush.py --tracemalloc      # 記憶體峰值改用 tracemalloc (linux 預設用 peak RSS)
+"""
+import argparse, contextlib, io, os, shutil, tempfile, time, tracemalloc
+import numpy as np
+import pandas as pd
+from sqlalchemy import event
+
+SLOPE_WARN = 1.2        # 延遲對 batch 大小的 log-log 斜率超過這個值就標記
+PREFILL_CHUNK = 50_000  # 灌歷史資料時每次 flush 的筆數
+
+
+class PeakMemory:
+    """
+    量每個週期的記憶體峰值，回傳比週期開始時多用了多少 MB
+    linux: 開始前寫 /proc/self/clear_refs 重設 VmHWM (peak RSS)，結束後讀 VmHWM - 開始時的 VmRSS。
+           allocator 重用之前釋放的記憶體時不會增加 RSS，所以可能是 0
+    其他平台或 use_tracemalloc: tracemalloc 的 peak (只算 python / numpy 配置的記憶體，但很精確；會讓整體變慢)
+    """
+
+    def __init__(self, use_tracemalloc = False):
+        self.method = "tracemalloc"
+        if not use_tracemalloc:
+            try:
+                with open("/proc/self/clear_refs", "w") as f:
+                    f.write("5")
+                self.method = "rss"
+            except OSError:
+                pass
+        if self.method == "tracemalloc":
+            tracemalloc.start()
+
+    def _status_kb(self, field):
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1])
+
+    def start(self):
+        if self.method == "rss":
+            with open("/proc/self/clear_refs", "w") as f:
+                f.write("5")
+            self._base = self._status_kb("VmRSS") * 1024
+        else:
+            tracemalloc.reset_peak()
+            self._base = tracemalloc.get_traced_memory()[0]
+
+    def stop(self) -> float:
+        if self.method == "rss":
+            peak = self._status_kb("VmHWM") * 1024
+        else:
+            peak = tracemalloc.get_traced_memory()[1]
+        return max(peak - self._base, 0) / 1024 / 1024
+
+
+class StatementCounter:
+    """計算 engine 送出的 statement 數 (executemany 算一個)"""
+
+    def __init__(self, engine):
+        self.count = 0
+        event.listen(engine, "before_cursor_execute", self._on_execute)
+
+    def _on_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self.count += 1
+
+
+def percentiles(values):
+    return {f"p{p}": float(np.percentile(values, p)) * 1000 for p in (50, 95, 99)}
+
+
+def run(args):
+    # 在 import config 之前決定 DB，load_dotenv 不會覆蓋已經設定的環境變數
+    os.environ["DB_TYPE"] = "sqlite"
+    os.environ["SCHEMA_MODE"] = args.schema_mode
+    # 不會呼叫 spotify API，但 get_config 會檢查這些變數，沒設定的話給假值
+    for name in ["SPOTIFY_CLIENT_ID", "SPOTIFY_CLIENT_SECRET", "SPOTIFY_REDIRECT_URI"]:
+        os.environ.setdefault(name, "bench")
+    from config import get_db_engine
+    from spotify_log import migrations, synthetic
+
+    catalog = synthetic.make_catalog(args.tracks, seed = args.seed)
+    history_levels = sorted(int(x) for x in args.history.split(","))
+    batches = sorted(int(x) for x in args.batches.split(","))
+    quiet = contextlib.redirect_stdout(io.StringIO()) if not args.verbose else contextlib.nullcontext()
+
+    workdir = tempfile.mkdtemp(prefix = "bench_flush_")
+    os.environ["SQLITE_PATH"] = os.path.join(workdir, "bench.db")
+    try:
+        migrations.migrate()
+        _bench(args, catalog, history_levels, batches, quiet)
+
+    finally:
+        if args.keep:
+            print(f"\nDB 保留在 {os.environ['SQLITE_PATH']}")
+        else:
+            get_db_engine().dispose()
+            shutil.rmtree(workdir, ignore_errors = True)
+
+
+def _bench(args, catalog, history_levels, batches, quiet):
+    from config import get_db_engine
+    from spotify_log import db_utils, synthetic
+
+    counter = StatementCounter(get_db_engine())
+    memory = PeakMemory(args.tracemalloc)
+
+    clock = pd.Timestamp("2020-01-01", tz = "UTC")
+    seed = args.seed
+    history = 0
+    results = []
+
+    def next_plays(n):
+        nonlocal clock, seed
+        seed += 1
+        df = synthetic.generate_plays(catalog, n, clock, seed = seed)
+        clock = pd.Timestamp(df["played_at"].iloc[-1]) + pd.Timedelta(minutes = 10)
+        return df
+
+    print(f"DB: {os.environ['SQLITE_PATH']} (schema_mode={args.schema_mode}, catalog={args.tracks} tracks)")
+    print(f"記憶體: 每個週期的峰值 - 週期開始時 ({'peak RSS' if memory.method == 'rss' else 'tracemalloc，只含 python 配置'})")
+    for level in history_levels:
+        # 1. 把 logs 灌到這個歷史筆數 (走同一個 insert_data_from_df)
+        while history < level:
+            n = min(PREFILL_CHUNK, level - history)
+            with quiet:
+                db_utils.insert_data_from_df(next_plays(n))
+            history += n
+        print(f"\n== logs 約 {history:,} 筆 ==")
+        print(f"{'batch':>7} {'flushes':>7} {'check p50/p95/p99 ms':>24} {'insert p50/p95/p99 ms':>25} {'us/row':>8} {'stmts/cycle':>11} {'peak +MB':>9}")
+
+        # 2. 每個 batch 大小跑 rounds 次完整週期: 抓到 batch 筆 -> should_update_db -> (達門檻) insert_data_from_df
+        for batch in batches:
+            check_t, insert_t, stmts, peaks = [], [], [], []
+            flushes = 0
+            for _ in range(args.rounds):
+                df = next_plays(batch)
+                before = counter.count
+                memory.start()
+                with quiet:
+                    start = time.perf_counter()
+                    combined = db_utils.should_update_db(df)
+                    check_t.append(time.perf_counter() - start)
+
+                    insert_t.append(0.0)
+                    if combined is not False:
+                        start = time.perf_counter()
+                        db_utils.insert_data_from_df(combined)
+                        insert_t[-1] = time.perf_counter() - start
+                        flushes += 1
+                        history += len(combined)
+                peaks.append(memory.stop())
+                stmts.append(counter.count - before)
+
+            check, insert = percentiles(check_t), percentiles(insert_t)
+            total_p50 = (np.median(check_t) + np.median(insert_t))
+            results.append({"history": level, "batch": batch, "p50": total_p50})
+            print(f"{batch:>7} {flushes:>7} "
+                  f"{check['p50']:>8.1f}/{check['p95']:>6.1f}/{check['p99']:>7.1f} "
+                  f"{insert['p50']:>9.1f}/{insert['p95']:>6.1f}/{insert['p99']:>7.1f} "
+                  f"{total_p50 / batch * 1e6:>8.1f} {np.mean(stmts):>11.1f} "
+                  f"{max(peaks):>9.1f}")
+
+        # 3. 超線性檢查: 只看會 flush 的 batch (>= 50)
+        points = [(r["batch"], r["p50"]) for r in results if r["history"] == level and r["batch"] >= 50]
+        if len(points) >= 2:
+            x, y = np.log([p[0] for p in points]), np.log([p[1] for p in points])
+            slope = np.polyfit(x, y, 1)[0]
+            flag = "  <-- 超線性" if slope > SLOPE_WARN else ""
+            print(f"延遲對 batch 的 log-log 斜率: {slope:.2f}{flag}")
+
+    # 4. 同一個 batch 在不同歷史筆數下的變化 (有 index 的話應該接近持平)
+    if len(history_levels) >= 2:
+        print("\n== 歷史筆數的影響 (p50 總延遲，最大歷史 / 最小歷史) ==")
+        for batch in batches:
+            rows = [r for r in results if r["batch"] == batch]
+            print(f"batch {batch:>6}: {rows[-1]['p50'] / rows[0]['p50']:.2f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(description = "buffer / flush 路徑的壓力測試 (本地 SQLite)")
+    parser.add_argument("--history", default = "0,100000", help = "logs 的歷史筆數，逗號分隔")
+    parser.add_argument("--batches", default = "10,50,500,5000", help = "每次抓到的筆數，逗號分隔")
+    parser.add_argument("--rounds", type = int, default = 5, help = "每個 batch 大小跑幾次")
+    parser.add_argument("--tracks", type = int, default = 20000, help = "合成 catalog 的曲目數")
+    parser.add_argument("--schema-mode", default = "text", choices = ["text", "surrogate"])
+    parser.add_argument("--seed", type = int, default = 0)
+    parser.add_argument("--keep", action = "store_true", help = "保留測試用的 DB 檔")
+    parser.add_argument("--tracemalloc", action = "store_true", help = "用 tracemalloc 量記憶體峰值 (較精確，但延遲會變高)")
+    parser.add_argument("--verbose", action = "store_true", help = "顯示 flush 過程的輸出")
+    run(parser.parse_args())
+
+
+if __name__ == "__main__":
+    main()
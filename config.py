@@ -22,6 +22,15 @@ REQUIRED_GITHUB_ACTIONS = ["REFRESH_TOKEN"]
 # 有連接 supabase 要有的
 REQUIRED_SUPABASE_VARS = ['SUPABASE_URI']
 
+# 本地嵌入式 sqlite 的預設檔案 (可用 SQLITE_PATH 覆寫，相對路徑以 repo 根目錄為準)
+DEFAULT_SQLITE_PATH = "spotify_local.db"
+
+# schema 模式 (SCHEMA_MODE):
+#   text:      tables 直接用 spotify id (TEXT) 當 key、做 join
+#   surrogate: albums / artists / tracks 用 integer surrogate key (sk)，spotify id 保留成 unique 欄位
+#              logs / track_artists 改用 sk 關聯，index 比較小、join 比較快。切換後無法再切回 text
+DEFAULT_SCHEMA_MODE = "text"
+
 def get_config(db_type = None):
 
     # 1. 判斷環境
@@ -37,7 +46,7 @@ def get_config(db_type = None):
         # spotify
         "client_id": os.getenv("SPOTIFY_CLIENT_ID"),
         "client_secret": os.getenv("SPOTIFY_CLIENT_SECRET"),
-        "scopes": ["user-read-recently-played"],   
+        "scopes": ["user-read-recently-played", "user-read-currently-playing"],
         "page_limit": 50,
 
         # turso
@@ -47,6 +56,12 @@ def get_config(db_type = None):
         # supabase
         'supabase_uri': os.getenv('SUPABASE_URI'),
 
+        # sqlite
+        'sqlite_path': os.getenv('SQLITE_PATH', DEFAULT_SQLITE_PATH),
+
+        # schema
+        'schema_mode': os.getenv('SCHEMA_MODE') or DEFAULT_SCHEMA_MODE,
+
         # env
         "is_cloud": is_github_actions
     }
@@ -71,10 +86,14 @@ def get_config(db_type = None):
             "db_type": db_type,
             "redirect_uri": os.getenv("SPOTIFY_REDIRECT_URI"),
             "token_file": BASE / "env" / "token.json",
+            # 相對路徑以 repo 根目錄為準 (同 token_file)，從別的目錄執行 (e.g., cron) 也會用同一個 DB 檔
+            # (絕對路徑的話 BASE / path 就是 path 本身)
+            "sqlite_path": str(BASE / config['sqlite_path']),
         })
 
-    # 5. 檢查必要環境變數有沒有缺
+    # 5. 檢查必要環境變數有沒有缺、schema 模式
     _check_required_env_vars(config['db_type'], is_github_actions)
+    _check_schema_mode(config['schema_mode'])
 
     # 6. 增加資料庫相關 config
     config.update(_get_db_config(config['db_type']))
@@ -84,7 +103,37 @@ def get_config(db_type = None):
 
 def get_db_connection():
 
-    """取得資料庫連線（根據環境），回傳資料庫連線物件 conn"""
+    """取得資料庫連線（根據環境），回傳已開啟交易的連線物件 conn"""
+
+    return get_db_engine().begin()
+
+
+# 同一個 process 共用 engine (連線池)，不用每次查詢都重新建立連線
+_engines = {}
+
+
+def _sqlite_transactional(engine):
+    """
+    python 的 sqlite3 driver 到第一個 INSERT/UPDATE 才會開 transaction，之前的 DDL (CREATE TABLE 等) 會直接 commit。
+    改成由 SQLAlchemy 自己送 BEGIN，讓 engine.begin() 裡的 DDL 也能一起 rollback (SQLAlchemy 文件的 pysqlite 做法)
+    """
+    from sqlalchemy import event
+
+    @event.listens_for(engine, "connect")
+    def _disable_driver_transactions(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(engine, "begin")
+    def _begin(conn):
+        if conn.get_execution_options().get("isolation_level") != "AUTOCOMMIT":
+            conn.exec_driver_sql("BEGIN")
+
+    return engine
+
+
+def get_db_engine():
+
+    """取得資料庫 engine（根據環境）。需要自己控制交易時使用 (e.g., CREATE INDEX CONCURRENTLY)"""
 
     config = get_config()
 
@@ -92,13 +141,18 @@ def get_db_connection():
         # print("連線到 supabase")
         from sqlalchemy import create_engine
         DATABASE_URL = config['supabase_uri']
-        engine = create_engine(DATABASE_URL)
-        return engine.begin()
-    
-    # if not config['use_turso']:
-    #     print("連線到本地 SQLite")
-    #     import sqlite3
-    #     return sqlite3.connect(config['sqlite_path'])
+        if DATABASE_URL not in _engines:
+            # pooler 會關掉閒置太久的連線，取用前先 ping
+            _engines[DATABASE_URL] = create_engine(DATABASE_URL, pool_pre_ping = True)
+        return _engines[DATABASE_URL]
+
+    if config['use_sqlite']:
+        # print("連線到本地 SQLite")
+        from sqlalchemy import create_engine
+        DATABASE_URL = f"sqlite:///{config['sqlite_path']}"
+        if DATABASE_URL not in _engines:
+            _engines[DATABASE_URL] = _sqlite_transactional(create_engine(DATABASE_URL))
+        return _engines[DATABASE_URL]
     
     # if config['use_embedded']:
     #     print("連線到 Turso (Embedded Replicas)")
@@ -128,7 +182,7 @@ def get_db_connection():
 def _check_db_type(db_type):
     """ 檢查本地的 db_type 有沒有效 """
     # valid_types = ['sqlite', 'turso', 'turso_embedded', 'supabase']
-    valid_types = ['supabase']
+    valid_types = ['supabase', 'sqlite']
     if db_type not in valid_types:
         raise ValueError(
             f"無效的 db_type: '{db_type}'。"
@@ -136,6 +190,16 @@ def _check_db_type(db_type):
         )
 
 
+def _check_schema_mode(schema_mode):
+    """ 檢查 schema_mode 有沒有效 """
+    valid_modes = ['text', 'surrogate']
+    if schema_mode not in valid_modes:
+        raise ValueError(
+            f"無效的 SCHEMA_MODE: '{schema_mode}'。"
+            f"有效選項: {', '.join(valid_modes)}"
+        )
+
+
 def _check_required_env_vars(db_type, env_is_github_actions):
     """
     檢查需要的 env 是否都存在
@@ -190,7 +254,12 @@ def _get_db_config(db_type):
         'supabase': {
             # 'use_turso': False,
             # 'use_embedded': False,
-            'use_supabase': True
+            'use_supabase': True,
+            'use_sqlite': False
+        },
+        'sqlite': {
+            'use_supabase': False,
+            'use_sqlite': True
         }
     }
     return db_configs[db_type]
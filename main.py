@@ -1,4 +1,4 @@
-from spotify_log import db_utils
+from spotify_log import db_utils, migrations, enrich
 import pandas as pd, time
 from config import get_config
 
@@ -13,7 +13,8 @@ if not my_config["is_cloud"]:
     df = auth_code_flow.fetch_recently_played(tok)
 else:
     from spotify_log import refresh_tok_flow
-    df = refresh_tok_flow.fetch_recently_played(my_config['refresh_token'])
+    tok = refresh_tok_flow.refresh_access_token(my_config['refresh_token'])
+    df = refresh_tok_flow.fetch_recently_played(tok)
 print(f"⏱️ 取得 Spotify 資料: {time.time() - start:.2f}s")
 
 # 如果在本地，就順便存 csv. 提供 debug 素材
@@ -22,11 +23,16 @@ if not my_config["is_cloud"]:
     file_path  = utils.get_csv_path()
     df.to_csv(file_path)
 
-# 更新到 db
-db_utils.create_tables_if_not_exists()
+# 更新到 db (schema 已是最新版本時只會檢查一次版本號)
+migrations.migrate()
 start = time.time()
 should_update = db_utils.should_update_db(df)
 print(f"⏱️ should_update_db: {time.time()-start:.2f}s")
 if should_update is not False:
     print(f"📊 準備 flush {should_update.shape[0]} 筆資料到 main tables")
-    db_utils.insert_data_from_df(should_update)
\ No newline at end of file
+    inserted = db_utils.insert_data_from_df(should_update)
+
+    # 對這次新增的 artists (加上之前沒補到的) 補 genres。失敗不會讓這次執行失敗，下次會再補
+    start = time.time()
+    enrich.enrich_inserted(inserted, tok)
+    print(f"⏱️ enrich 新 artists: {time.time()-start:.2f}s")
\ No newline at end of file
@@ -181,31 +181,5 @@ def fetch_recently_played(tok):
     return pd.concat(items)
 
 
-def fetch_artist_genres(artist_id_list, tok):
-    access_token = tok["access_token"]
-    url = "https://api.spotify.com/v1/artists"
-    
-    results = []
-
-    for i in range(0, len(artist_id_list), 50):
-        batch = artist_id_list[i:i+50]
-        ids_str = ','.join(batch)
-        
-        r = requests.get(url, headers={"Authorization": f"Bearer {access_token}"},
-                         params={"ids": ids_str}, timeout=30)
-        r.raise_for_status()
-        
-        artists = r.json()['artists']
-        for artist in artists:
-            results.append({
-                'id': artist['id'],
-                'genres': artist['genres']
-            })
-        
-        time.sleep(0.2)
-    
-    return pd.DataFrame(results)
-
-
 if __name__ == "__main__":
     pass
\ No newline at end of file
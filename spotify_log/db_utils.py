@@ -1,91 +1,10 @@
 import pandas as pd
 from config import get_db_connection
-from sqlalchemy import text
+from spotify_log.storage import get_backend
+from sqlalchemy import text, bindparam, DateTime
 import time
 
 
-def create_tables_if_not_exists():
-
-   with get_db_connection() as conn:
-    
-    # parent table: albums
-    conn.execute(text("""
-    CREATE TABLE IF NOT EXISTS albums (
-      id TEXT NOT NULL PRIMARY KEY,
-      album TEXT,
-      total_tracks INT,
-      release_date DATE
-    );"""))
-
-    # parent table: artists
-    conn.execute(text("""
-    CREATE TABLE IF NOT EXISTS artists (
-      id TEXT NOT NULL PRIMARY KEY,
-      artist TEXT NOT NULL,
-      genres TEXT[]
-    );
-    CREATE INDEX IF NOT EXISTS idx_artists_genres_null ON artists(id) WHERE genres IS NULL;
-    """))
-
-    conn.execute(text("""
-    CREATE TABLE IF NOT EXISTS tracks (
-      id TEXT NOT NULL PRIMARY KEY,
-      track TEXT NOT NULL,
-      album_id TEXT,
-      duration_ms INTEGER NOT NULL,
-      track_number INTEGER,
-                  
-      FOREIGN KEY (album_id) REFERENCES albums(id) ON DELETE CASCADE
-    );
-    """))
-
-    # junction table
-    conn.execute(text("""
-    CREATE TABLE IF NOT EXISTS track_artists (
-      track_id TEXT NOT NULL,
-      artist_id TEXT NOT NULL,
-      artist_order INTEGER NOT NULL,
-      
-      PRIMARY KEY (track_id, artist_id),
-      FOREIGN KEY (track_id) REFERENCES tracks(id) ON DELETE CASCADE,
-      FOREIGN KEY (artist_id) REFERENCES artists(id) ON DELETE CASCADE
-    );
-    """))
-
-    conn.execute(text("""
-    CREATE TABLE IF NOT EXISTS logs (
-      id SERIAL PRIMARY KEY,  
-      track_id TEXT NOT NULL,
-      played_at TIMESTAMP WITHOUT TIME ZONE NOT NULL, 
-      context_type TEXT,
-      context_uri TXET,
-      
-      FOREIGN KEY (track_id) REFERENCES tracks(id) ON DELETE CASCADE,
-      UNIQUE (track_id, played_at)
-    );
-    """))
-
-    # 方便用，不符合 atomic
-    conn.execute(text("""
-    CREATE TABLE IF NOT EXISTS cache (
-      artist TEXT[] NOT NULL,   -- array
-      artist_id TEXT[] NOT NULL,
-      track TEXT NOT NULL,
-      track_id TEXT NOT NULL,
-      album TEXT,
-      album_id TEXT,
-      total_tracks INTEGER,
-      duration_ms INTEGER NOT NULL,
-      played_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
-      track_number INTEGER,
-      release_date DATE,
-      context_type TEXT,
-      context_uri TXET,
-      PRIMARY KEY (track_id, played_at)
-    );
-    """))
-
-
 def process_datetime_for_sql(s: pd.Series, type):
     """
     把 datetime 序列，轉換成字串
@@ -143,18 +62,14 @@ def should_update_db(df):
     把新的聆聽紀錄加進 cache table. 當 cahce table 蒐集到一定的量(e.g., 超過 50 筆)，再 flush 進 5 個 tables.
     Return False 或 cache_df
     """
+    backend = get_backend()
     try:
         df["played_at"] = process_datetime_for_sql(df["played_at"], type = "datetime")
         df["release_date"] = process_datetime_for_sql(df["release_date"], type = "date")
         with get_db_connection() as conn:
-            # 讀取整個 cache
-            cache = pd.read_sql("SELECT * FROM cache ORDER BY played_at DESC", conn)
-
-            if not cache.empty:
-                # 型別轉換、過濾"新資料"
-                cache["played_at"] = pd.to_datetime(cache["played_at"])
-                cache["release_date"] = pd.to_datetime(cache["release_date"])
-                latest_time = cache['played_at'].max()
+            # 先只問 cache 最新時間 (watermark)，沒有新資料就不用讀整個 cache
+            latest_time = backend.get_watermark(conn)
+            if latest_time is not None:
                 new_data = df[df['played_at'] > latest_time].copy()
             else:
                 new_data = df.copy()
@@ -162,6 +77,12 @@ def should_update_db(df):
             if len(new_data) == 0:
                 print("無新的聆聽紀錄")
                 return False
+
+            # 讀取整個 cache、型別轉換
+            cache = backend.read_buffer(conn)
+            if not cache.empty:
+                cache["played_at"] = pd.to_datetime(cache["played_at"])
+                cache["release_date"] = pd.to_datetime(cache["release_date"])
             
             # 合併新舊資料
             combined = pd.concat([cache, new_data], ignore_index=True)
@@ -170,8 +91,8 @@ def should_update_db(df):
             if combined.shape[0] >= 50: 
                 return combined    # 清空快取 insert_date 再處理
             else:
-                conn.execute(text("DELETE FROM cache"))
-                combined.to_sql("cache", conn, if_exists="append", index=False)
+                # cache 裡原本的資料不變，只要加上新資料
+                backend.append_buffer(conn, new_data)
                 print(f" Cache 更新：新增 {new_data.shape[0]} 筆，總計 {combined.shape[0]} 筆")
                 return False
 
@@ -180,43 +101,17 @@ def should_update_db(df):
         raise
 
 
-def postgres_upsert(table, conn, keys, data_iter):
-    from sqlalchemy.dialects.postgresql import insert
-    from sqlalchemy import MetaData, Table
-    
-    data_dicts = [dict(zip(keys, row)) for row in data_iter]
-    
-    if not data_dicts:
-        return 0
-        
-    conflict_columns = {
-        'albums': ['id'],
-        'artists': ['id'],
-        'tracks': ['id'],
-        'track_artists': ['track_id', 'artist_id'],
-        'logs': ['track_id', 'played_at'],
-    }
-    
-    metadata = MetaData()
-    table_obj = Table(table.name, metadata, autoload_with = conn.engine)
-    
-    stmt = insert(table_obj).values(data_dicts)
-    stmt = stmt.on_conflict_do_nothing(
-        index_elements = conflict_columns[table.name]
-    )
-    
-    conn.execute(stmt)
-    
-    return len(data_dicts)
-
-
-
 def insert_data_from_df(df: pd.DataFrame):
-    
+    """
+    把 df flush 進 5 個 main tables，cache 只留最新一筆
+    Return 這次真的新增的 spotify id: {"albums": set, "artists": set}，給 flush 後的 enrichment 用
+    """
     df["played_at"] = process_datetime_for_sql(df["played_at"], type = "datetime")
     df["release_date"] = process_datetime_for_sql(df["release_date"], type = "date")
     df = df.sort_values(by='played_at').reset_index(drop=True)
     tables = split_df(df)
+    backend = get_backend()
+    inserted = {}
 
     try:
         with get_db_connection() as conn:
@@ -224,24 +119,30 @@ def insert_data_from_df(df: pd.DataFrame):
             # 先寫 parent table
             for table_name in ["albums", "artists", "tracks", "track_artists", "logs"]:
               start = time.time()
-              tables[table_name].to_sql(table_name, conn, if_exists="append", index=False, method = postgres_upsert)
+              new_ids = backend.upsert(conn, table_name, tables[table_name])
+              if table_name in ("albums", "artists"):
+                inserted[table_name] = new_ids
               print(f"   upsert into {table_name}: {time.time()-start:.2f}s")
 
             start = time.time()
-            conn.execute(text("DELETE FROM cache"))
             cache_to_keep = df.nlargest(1, 'played_at')
-            cache_to_keep.to_sql("cache", conn, if_exists="append", index=False)
+            backend.write_buffer(conn, cache_to_keep)
             print(f"更新 cache: {time.time()-start:.2f}s")
 
+            # 讓讀取端 (read_api) 的快取失效
+            backend.bump_generation(conn)
+
+        return inserted
+
     except Exception as e:
+        backend.rollback()
         print(f"寫入 {table_name} 發生資料庫錯誤: {e}")
         raise
 
-def get_artists_without_genres() -> list:
+def get_artists_without_genres(limit: int = None) -> list:
     try:
         with get_db_connection() as conn:
-            df = pd.read_sql("SELECT id FROM artists WHERE genres IS NULL", conn)
-            return df['id'].tolist()
+            return get_backend().get_artists_without_genres(conn, limit)
     
     except Exception as e:
         print(f"查詢 artists 發生錯誤: {e}")
@@ -250,20 +151,152 @@ def get_artists_without_genres() -> list:
 def insert_genres_data(genres_df):
     try:
         with get_db_connection() as conn:
-            # 先建臨時表
-            genres_df.to_sql('temp_genres', conn, if_exists='replace', index=False)
-            
-            conn.execute(text("""
-                UPDATE artists 
-                SET genres = temp_genres.genres::text[]
-                FROM temp_genres
-                WHERE artists.id = temp_genres.id
-            """))
-            conn.execute(text("DROP TABLE temp_genres"))
+            backend = get_backend()
+            backend.update_genres(conn, genres_df)
+            backend.bump_generation(conn)
 
     except Exception as e:
         print(f"更新 genres 發生錯誤: {e}")
         raise
 
+def insert_play_segments(df: pd.DataFrame, df_segments: pd.DataFrame):
+    """
+    把 now-playing sampler 的播放片段寫進 play_segments
+    df: parse_track 格式，片段用到的 track。跳過的歌不會出現在 recently-played，所以 track / album / artist 這裡也要 upsert
+    df_segments: track_id, started_at, ended_at, progress_start_ms, progress_end_ms, end_reason
+    Return 這次真的新增的 spotify id: {"albums": set, "artists": set}，同 insert_data_from_df
+    """
+    df = df.copy()
+    df["release_date"] = process_datetime_for_sql(df["release_date"], type = "date")
+    tables = split_df(df)
+
+    df_segments = df_segments.copy()
+    for col in ["started_at", "ended_at"]:
+      df_segments[col] = process_datetime_for_sql(df_segments[col], type = "datetime")
+    tables["play_segments"] = df_segments.drop_duplicates(["track_id", "started_at"])
+
+    backend = get_backend()
+    inserted = {}
+
+    try:
+        with get_db_connection() as conn:
+            for table_name in ["albums", "artists", "tracks", "track_artists", "play_segments"]:
+              new_ids = backend.upsert(conn, table_name, tables[table_name])
+              if table_name in ("albums", "artists"):
+                inserted[table_name] = new_ids
+
+        return inserted
+
+    except Exception as e:
+        backend.rollback()
+        print(f"寫入 {table_name} (play segments) 發生資料庫錯誤: {e}")
+        raise
+
+# ========== 讀取 (聆聽統計) ===========
+# 回傳 list[dict]，可以直接轉成 JSON。days 為 None 表示全部時間
+
+def get_flush_generation() -> int:
+    """目前的資料版本，每次 flush / 更新 genres 會 +1"""
+    with get_db_connection() as conn:
+        return get_backend().get_generation(conn)
+
+
+def _since(days):
+    if days is None:
+        return None
+    return (pd.Timestamp.now(tz='UTC').tz_localize(None) - pd.Timedelta(days=days)).to_pydatetime()
+
+
+def _run_stats_query(sql, days = None, **params):
+    """sql 中的 {since} 會依 days 換成 played_at 條件，{joins[...]}、{genres_join}、{genre} 換成後端對應的 SQL"""
+    backend = get_backend()
+    since = _since(days)
+    sql = sql.format(
+        since = "AND l.played_at >= :since" if since is not None else "",
+        joins = backend.joins,
+        genres_join = backend.GENRES_JOIN,
+        genre = backend.GENRE_COLUMN,
+    )
+    stmt = text(sql)
+    if since is not None:
+        stmt = stmt.bindparams(bindparam("since", type_=DateTime()))
+        params["since"] = since
+
+    try:
+        with get_db_connection() as conn:
+            return [dict(row) for row in conn.execute(stmt, params).mappings()]
+
+    except Exception as e:
+        print(f"查詢聆聽統計發生錯誤: {e}")
+        raise
+
+
+def get_top_tracks(days = None, limit = 10) -> list:
+    return _run_stats_query("""
+        SELECT t.id AS track_id, t.track, COUNT(*) AS plays
+        FROM logs l
+        JOIN tracks t ON {joins[logs_tracks]}
+        WHERE 1 = 1 {since}
+        GROUP BY t.id, t.track
+        ORDER BY plays DESC, t.track
+        LIMIT :limit
+    """, days, limit = limit)
+
+
+def get_top_artists(days = None, limit = 10) -> list:
+    return _run_stats_query("""
+        SELECT ar.id AS artist_id, ar.artist, COUNT(*) AS plays
+        FROM logs l
+        JOIN tracks t ON {joins[logs_tracks]}
+        JOIN track_artists ta ON {joins[tracks_track_artists]}
+        JOIN artists ar ON {joins[track_artists_artists]}
+        WHERE 1 = 1 {since}
+        GROUP BY ar.id, ar.artist
+        ORDER BY plays DESC, ar.artist
+        LIMIT :limit
+    """, days, limit = limit)
+
+
+def get_top_genres(days = None, limit = 10) -> list:
+    return _run_stats_query("""
+        SELECT {genre} AS genre, COUNT(*) AS plays
+        FROM logs l
+        JOIN tracks t ON {joins[logs_tracks]}
+        JOIN track_artists ta ON {joins[tracks_track_artists]}
+        JOIN artists ar ON {joins[track_artists_artists]}
+        {genres_join}
+        WHERE 1 = 1 {since}
+        GROUP BY {genre}
+        ORDER BY plays DESC, genre
+        LIMIT :limit
+    """, days, limit = limit)
+
+
+def get_recent_plays(limit = 20) -> list:
+    rows = _run_stats_query("""
+        SELECT l.played_at, t.id AS track_id, t.track, al.album, l.context_type
+        FROM logs l
+        JOIN tracks t ON {joins[logs_tracks]}
+        LEFT JOIN albums al ON {joins[tracks_albums]}
+        ORDER BY l.played_at DESC
+        LIMIT :limit
+    """, limit = limit)
+    for row in rows:
+        row["played_at"] = pd.Timestamp(row["played_at"]).isoformat()
+    return rows
+
+
+def get_totals(days = None) -> dict:
+    rows = _run_stats_query("""
+        SELECT COUNT(*) AS plays,
+               CAST(COALESCE(SUM(t.duration_ms), 0) AS BIGINT) AS listened_ms,
+               COUNT(DISTINCT t.id) AS distinct_tracks
+        FROM logs l
+        JOIN tracks t ON {joins[logs_tracks]}
+        WHERE 1 = 1 {since}
+    """, days)
+    return rows[0]
+
+
 if __name__ == "__main__":
   pass    
\ No newline at end of file
@@ -0,0 +1,66 @@
+"""
+flush 後的 metadata 補齊 (enrichment)。
+insert_data_from_df 回傳這次真的新增的 id，這裡只對那些 id (加上之前失敗、genres 仍是 NULL 的一小批) 批次呼叫 API，
+不用再定期掃整個 artists table。本地 (auth code) 與 GitHub Actions (refresh token) 兩種流程共用。
+
+目前只有 artists 需要補 genres；albums 會存的欄位 (名稱、曲數、發行日) 在聆聽紀錄裡就有了。
+"""
+import time
+import requests
+import pandas as pd
+
+from spotify_log import db_utils
+
+ARTISTS_URL = "https://api.spotify.com/v1/artists"
+ARTISTS_BATCH_SIZE = 50   # /v1/artists 一次最多 50 個 id
+BACKLOG_LIMIT = 200       # 每次順便補幾位之前失敗留下的 artist
+
+
+def fetch_artist_genres(artist_id_list, tok):
+    access_token = tok["access_token"]
+
+    results = []
+
+    for i in range(0, len(artist_id_list), ARTISTS_BATCH_SIZE):
+        batch = artist_id_list[i:i+ARTISTS_BATCH_SIZE]
+        ids_str = ','.join(batch)
+
+        r = requests.get(ARTISTS_URL, headers={"Authorization": f"Bearer {access_token}"},
+                         params={"ids": ids_str}, timeout=30)
+        r.raise_for_status()
+
+        artists = r.json()['artists']
+        for artist in artists:
+            if artist is None:   # 無效的 id 會回傳 null
+                continue
+            results.append({
+                'id': artist['id'],
+                'genres': artist['genres']
+            })
+
+        time.sleep(0.2)
+
+    return pd.DataFrame(results, columns = ['id', 'genres'])
+
+
+def enrich_inserted(inserted: dict, tok):
+    """
+    補齊這次 flush 新增的 artists 的 genres，順便補之前失敗留下的 (genres IS NULL，最多 BACKLOG_LIMIT 位)
+    inserted: insert_data_from_df 的回傳值
+
+    失敗時只印出錯誤、不丟例外: flush 已經 commit 了，沒補到的 artist genres 仍是 NULL，下次執行會再補
+    """
+    try:
+        new_ids = set(inserted.get("artists", ()))
+        leftover_ids = set(db_utils.get_artists_without_genres(limit = BACKLOG_LIMIT)) - new_ids
+        artist_ids = sorted(new_ids) + sorted(leftover_ids)
+        if not artist_ids:
+            print("無新的 artist，不需更新 genres")
+            return
+
+        genres_df = fetch_artist_genres(artist_ids, tok)
+        db_utils.insert_genres_data(genres_df)
+        print(f" 更新 {genres_df.shape[0]} 位 artist 的 genres (新增 {len(new_ids)}，之前未補 {len(leftover_ids)})")
+
+    except Exception as e:
+        print(f"更新 artist 的 genres 發生錯誤，下次執行會再補: {e}")
@@ -0,0 +1,626 @@
+"""
+輕量的 schema migration。
+每個 migration 有遞增的 version，套用後記錄在 schema_version table。
+main.py 每次執行只會送一個 SELECT 檢查版本，已是最新就不會送任何 DDL。
+
+新增 migration: 在 POSTGRES_MIGRATIONS / SQLITE_MIGRATIONS 最後面各加一個 version + 1 的 dict
+(sqlite 不需要的話 statements 留空，讓兩邊版本號一致)。
+一般的 migration (含 DDL) 在同一個 transaction 內執行，失敗會整個 rollback，修正後重跑即可
+(sqlite 靠 config.get_db_engine 明確送 BEGIN，否則 DDL 會各自 commit)。
+concurrent = True 的 migration 會在 autocommit 下執行，給 CREATE INDEX CONCURRENTLY 用 (不能在 transaction 內)，
+statements 要寫成可重覆執行 (IF NOT EXISTS 等)。中途失敗留下的 INVALID index 會在重跑時先 drop 掉。
+有 mode 的 migration 只在 config 的 schema_mode 相同時套用 (e.g., surrogate key 轉換)。
+沒有 mode 的 migration 兩種 schema 模式都會跑，所以不能依賴 logs.track_id 等只存在於 text 模式的欄位。
+"""
+import re
+from sqlalchemy import text, inspect
+from sqlalchemy.exc import OperationalError, ProgrammingError
+
+from config import get_config, get_db_connection, get_db_engine
+
+CONCURRENT_INDEX_RE = re.compile(r"\s*CREATE\s+(?:UNIQUE\s+)?INDEX\s+CONCURRENTLY\s+IF\s+NOT\s+EXISTS\s+(\w+)", re.IGNORECASE)
+
+
+SCHEMA_VERSION_DDL = """
+CREATE TABLE IF NOT EXISTS schema_version (
+  version INTEGER NOT NULL PRIMARY KEY,
+  name TEXT NOT NULL,
+  applied_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);"""
+
+
+# ========== PostgreSQL (supabase) ===========
+POSTGRES_MIGRATIONS = [
+    {
+        "version": 1,
+        "name": "baseline",
+        "concurrent": False,
+        "statements": [
+            # parent table: albums
+            """
+            CREATE TABLE IF NOT EXISTS albums (
+              id TEXT NOT NULL PRIMARY KEY,
+              album TEXT,
+              total_tracks INT,
+              release_date DATE
+            );""",
+            # parent table: artists
+            """
+            CREATE TABLE IF NOT EXISTS artists (
+              id TEXT NOT NULL PRIMARY KEY,
+              artist TEXT NOT NULL,
+              genres TEXT[]
+            );""",
+            "CREATE INDEX IF NOT EXISTS idx_artists_genres_null ON artists(id) WHERE genres IS NULL;",
+            """
+            CREATE TABLE IF NOT EXISTS tracks (
+              id TEXT NOT NULL PRIMARY KEY,
+              track TEXT NOT NULL,
+              album_id TEXT,
+              duration_ms INTEGER NOT NULL,
+              track_number INTEGER,
+
+              FOREIGN KEY (album_id) REFERENCES albums(id) ON DELETE CASCADE
+            );""",
+            # junction table
+            """
+            CREATE TABLE IF NOT EXISTS track_artists (
+              track_id TEXT NOT NULL,
+              artist_id TEXT NOT NULL,
+              artist_order INTEGER NOT NULL,
+
+              PRIMARY KEY (track_id, artist_id),
+              FOREIGN KEY (track_id) REFERENCES tracks(id) ON DELETE CASCADE,
+              FOREIGN KEY (artist_id) REFERENCES artists(id) ON DELETE CASCADE
+            );""",
+            """
+            CREATE TABLE IF NOT EXISTS logs (
+              id SERIAL PRIMARY KEY,
+              track_id TEXT NOT NULL,
+              played_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+              context_type TEXT,
+              context_uri TEXT,
+
+              FOREIGN KEY (track_id) REFERENCES tracks(id) ON DELETE CASCADE,
+              UNIQUE (track_id, played_at)
+            );""",
+            # 方便用，不符合 atomic
+            """
+            CREATE TABLE IF NOT EXISTS cache (
+              artist TEXT[] NOT NULL,   -- array
+              artist_id TEXT[] NOT NULL,
+              track TEXT NOT NULL,
+              track_id TEXT NOT NULL,
+              album TEXT,
+              album_id TEXT,
+              total_tracks INTEGER,
+              duration_ms INTEGER NOT NULL,
+              played_at TIMESTAMP WITHOUT TIME ZONE NOT NULL,
+              track_number INTEGER,
+              release_date DATE,
+              context_type TEXT,
+              context_uri TEXT,
+              PRIMARY KEY (track_id, played_at)
+            );""",
+        ],
+    },
+    {
+        # 舊版 DDL 把 context_uri 寫成 TXET, 統一改回 TEXT (已經是 TEXT 的話不會重寫 table)
+        "version": 2,
+        "name": "fix_context_uri_type",
+        "concurrent": False,
+        "statements": [
+            "ALTER TABLE logs ALTER COLUMN context_uri TYPE TEXT;",
+            "ALTER TABLE cache ALTER COLUMN context_uri TYPE TEXT;",
+        ],
+    },
+    {
+        # dashboard 常用: 依時間範圍查 logs、從 artist 反查 tracks
+        # CONCURRENTLY 建 index 不會鎖住寫入。中途失敗留下的 INVALID index 由 migrate() 重跑時 drop 掉重建
+        "version": 3,
+        "name": "add_logs_played_at_and_artist_indexes",
+        "concurrent": True,
+        "statements": [
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_logs_played_at ON logs (played_at);",
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_track_artists_artist_id ON track_artists (artist_id);",
+        ],
+    },
+    {
+        # 轉換成 integer surrogate key (SCHEMA_MODE=surrogate 才會套用)
+        # 整個 migration 在同一個 transaction 內，失敗會全部 rollback
+        "version": 4,
+        "name": "surrogate_keys",
+        "mode": "surrogate",
+        "concurrent": False,
+        "statements": [
+            # 1. dimension tables 加上 sk (會幫既有資料編號)
+            "ALTER TABLE albums ADD COLUMN sk INTEGER GENERATED BY DEFAULT AS IDENTITY;",
+            "ALTER TABLE artists ADD COLUMN sk INTEGER GENERATED BY DEFAULT AS IDENTITY;",
+            "ALTER TABLE tracks ADD COLUMN sk INTEGER GENERATED BY DEFAULT AS IDENTITY;",
+
+            # 2. children 加上 sk 欄位，用 spotify id 回填
+            "ALTER TABLE tracks ADD COLUMN album_sk INTEGER;",
+            "UPDATE tracks t SET album_sk = a.sk FROM albums a WHERE a.id = t.album_id;",
+            "ALTER TABLE track_artists ADD COLUMN track_sk INTEGER, ADD COLUMN artist_sk INTEGER;",
+            "UPDATE track_artists ta SET track_sk = t.sk FROM tracks t WHERE t.id = ta.track_id;",
+            "UPDATE track_artists ta SET artist_sk = a.sk FROM artists a WHERE a.id = ta.artist_id;",
+            "ALTER TABLE logs ADD COLUMN track_sk INTEGER;",
+            "UPDATE logs l SET track_sk = t.sk FROM tracks t WHERE t.id = l.track_id;",
+
+            # 3. 移除舊的 TEXT 欄位 (相關的 FK / PK / UNIQUE / index 會一起被移除)
+            "ALTER TABLE tracks DROP COLUMN album_id;",
+            "ALTER TABLE track_artists DROP COLUMN track_id, DROP COLUMN artist_id;",
+            "ALTER TABLE logs DROP COLUMN track_id;",
+
+            # 4. dimension 的 PK 換成 sk, spotify id 保留成 unique natural key
+            "ALTER TABLE albums DROP CONSTRAINT albums_pkey, ADD PRIMARY KEY (sk), ADD UNIQUE (id);",
+            "ALTER TABLE artists DROP CONSTRAINT artists_pkey, ADD PRIMARY KEY (sk), ADD UNIQUE (id);",
+            "ALTER TABLE tracks DROP CONSTRAINT tracks_pkey, ADD PRIMARY KEY (sk), ADD UNIQUE (id);",
+
+            # 5. children 重新建立 key / FK
+            """
+            ALTER TABLE tracks
+              ADD FOREIGN KEY (album_sk) REFERENCES albums(sk) ON DELETE CASCADE;""",
+            """
+            ALTER TABLE track_artists
+              ALTER COLUMN track_sk SET NOT NULL,
+              ALTER COLUMN artist_sk SET NOT NULL,
+              ADD PRIMARY KEY (track_sk, artist_sk),
+              ADD FOREIGN KEY (track_sk) REFERENCES tracks(sk) ON DELETE CASCADE,
+              ADD FOREIGN KEY (artist_sk) REFERENCES artists(sk) ON DELETE CASCADE;""",
+            """
+            ALTER TABLE logs
+              ALTER COLUMN track_sk SET NOT NULL,
+              ADD UNIQUE (track_sk, played_at),
+              ADD FOREIGN KEY (track_sk) REFERENCES tracks(sk) ON DELETE CASCADE;""",
+            "CREATE INDEX IF NOT EXISTS idx_track_artists_artist_sk ON track_artists (artist_sk);",
+        ],
+    },
+    {
+        # cache 幾乎每次執行都會被清空、重寫，不需要寫 WAL。
+        # UNLOGGED table 在 DB crash 後會被清空；cache 只是還沒 flush 的 buffer，
+        # 只要 Spotify 最近 50 筆還涵蓋這段時間，下次執行就會補回來
+        "version": 5,
+        "name": "unlogged_cache",
+        "concurrent": False,
+        "statements": [
+            "ALTER TABLE cache SET UNLOGGED;",
+        ],
+    },
+    {
+        # 每次 flush / 更新 genres 就 +1，讀取端 (read_api.py) 用它判斷快取是否過期
+        "version": 6,
+        "name": "flush_generation",
+        "concurrent": False,
+        "statements": [
+            """
+            CREATE TABLE IF NOT EXISTS flush_generation (
+              id INTEGER NOT NULL PRIMARY KEY CHECK (id = 1),   -- 只有一列
+              generation BIGINT NOT NULL DEFAULT 0
+            );""",
+            "INSERT INTO flush_generation (id, generation) VALUES (1, 0) ON CONFLICT (id) DO NOTHING;",
+        ],
+    },
+    {
+        # now-playing sampler (sampler.py) 的播放片段，一個片段一列 (只存起訖，不存每次輪詢)
+        # 不加 FK: 之後轉 surrogate 時 migration 4 要先 drop tracks 的 PK，FK 會擋住；轉換由 migration 8 處理
+        "version": 7,
+        "name": "play_segments",
+        "mode": "text",
+        "concurrent": False,
+        "statements": [
+            """
+            CREATE TABLE IF NOT EXISTS play_segments (
+              track_id TEXT NOT NULL,
+              started_at TIMESTAMP NOT NULL,
+              ended_at TIMESTAMP NOT NULL,
+              progress_start_ms INTEGER NOT NULL,
+              progress_end_ms INTEGER NOT NULL,
+              end_reason TEXT NOT NULL,   -- completed / skipped / seeked / paused / stopped
+
+              PRIMARY KEY (track_id, started_at)
+            );""",
+        ],
+    },
+    {
+        # surrogate 模式的 play_segments: track_id -> track_sk
+        # 先用 text 的定義建表 (已經有 migration 7 的表時不會動)，再統一轉換，兩種情況共用同一組語法
+        "version": 8,
+        "name": "play_segments_surrogate",
+        "mode": "surrogate",
+        "concurrent": False,
+        "statements": [
+            """
+            CREATE TABLE IF NOT EXISTS play_segments (
+              track_id TEXT NOT NULL,
+              started_at TIMESTAMP NOT NULL,
+              ended_at TIMESTAMP NOT NULL,
+              progress_start_ms INTEGER NOT NULL,
+              progress_end_ms INTEGER NOT NULL,
+              end_reason TEXT NOT NULL,
+
+              PRIMARY KEY (track_id, started_at)
+            );""",
+            "ALTER TABLE play_segments ADD COLUMN track_sk INTEGER;",
+            "UPDATE play_segments s SET track_sk = t.sk FROM tracks t WHERE t.id = s.track_id;",
+            "DELETE FROM play_segments WHERE track_sk IS NULL;",
+            "ALTER TABLE play_segments DROP COLUMN track_id;",   # PK 一起被 drop
+            """
+            ALTER TABLE play_segments
+              ALTER COLUMN track_sk SET NOT NULL,
+              ADD PRIMARY KEY (track_sk, started_at),
+              ADD FOREIGN KEY (track_sk) REFERENCES tracks(sk) ON DELETE CASCADE;""",
+        ],
+    },
+]
+
+
+# ========== SQLite (本地嵌入式) ===========
+# array 欄位存成 JSON 字串 (見 storage.py)
+SQLITE_MIGRATIONS = [
+    {
+        "version": 1,
+        "name": "baseline",
+        "concurrent": False,
+        "statements": [
+            """
+            CREATE TABLE IF NOT EXISTS albums (
+              id TEXT NOT NULL PRIMARY KEY,
+              album TEXT,
+              total_tracks INTEGER,
+              release_date DATE
+            );""",
+            """
+            CREATE TABLE IF NOT EXISTS artists (
+              id TEXT NOT NULL PRIMARY KEY,
+              artist TEXT NOT NULL,
+              genres TEXT   -- JSON array
+            );""",
+            "CREATE INDEX IF NOT EXISTS idx_artists_genres_null ON artists(id) WHERE genres IS NULL;",
+            """
+            CREATE TABLE IF NOT EXISTS tracks (
+              id TEXT NOT NULL PRIMARY KEY,
+              track TEXT NOT NULL,
+              album_id TEXT,
+              duration_ms INTEGER NOT NULL,
+              track_number INTEGER,
+
+              FOREIGN KEY (album_id) REFERENCES albums(id) ON DELETE CASCADE
+            );""",
+            """
+            CREATE TABLE IF NOT EXISTS track_artists (
+              track_id TEXT NOT NULL,
+              artist_id TEXT NOT NULL,
+              artist_order INTEGER NOT NULL,
+
+              PRIMARY KEY (track_id, artist_id),
+              FOREIGN KEY (track_id) REFERENCES tracks(id) ON DELETE CASCADE,
+              FOREIGN KEY (artist_id) REFERENCES artists(id) ON DELETE CASCADE
+            );""",
+            """
+            CREATE TABLE IF NOT EXISTS logs (
+              id INTEGER PRIMARY KEY AUTOINCREMENT,
+              track_id TEXT NOT NULL,
+              played_at TIMESTAMP NOT NULL,
+              context_type TEXT,
+              context_uri TEXT,
+
+              FOREIGN KEY (track_id) REFERENCES tracks(id) ON DELETE CASCADE,
+              UNIQUE (track_id, played_at)
+            );""",
+            """
+            CREATE TABLE IF NOT EXISTS cache (
+              artist TEXT NOT NULL,      -- JSON array
+              artist_id TEXT NOT NULL,   -- JSON array
+              track TEXT NOT NULL,
+              track_id TEXT NOT NULL,
+              album TEXT,
+              album_id TEXT,
+              total_tracks INTEGER,
+              duration_ms INTEGER NOT NULL,
+              played_at TIMESTAMP NOT NULL,
+              track_number INTEGER,
+              release_date DATE,
+              context_type TEXT,
+              context_uri TEXT,
+              PRIMARY KEY (track_id, played_at)
+            );""",
+        ],
+    },
+    {
+        # sqlite 的 baseline 本來就是 TEXT
+        "version": 2,
+        "name": "fix_context_uri_type",
+        "concurrent": False,
+        "statements": [],
+    },
+    {
+        "version": 3,
+        "name": "add_logs_played_at_and_artist_indexes",
+        "concurrent": False,
+        "statements": [
+            "CREATE INDEX IF NOT EXISTS idx_logs_played_at ON logs (played_at);",
+            "CREATE INDEX IF NOT EXISTS idx_track_artists_artist_id ON track_artists (artist_id);",
+        ],
+    },
+    {
+        # 轉換成 integer surrogate key (SCHEMA_MODE=surrogate 才會套用)
+        # sqlite 不能改 PK，所以建新表、搬資料、再換名字
+        # 先清掉舊版 runner 失敗時可能留下的 *_new (之前 sqlite 的 DDL 不會 rollback)
+        "version": 4,
+        "name": "surrogate_keys",
+        "mode": "surrogate",
+        "concurrent": False,
+        "statements": [
+            "DROP TABLE IF EXISTS logs_new;",
+            "DROP TABLE IF EXISTS track_artists_new;",
+            "DROP TABLE IF EXISTS tracks_new;",
+            "DROP TABLE IF EXISTS artists_new;",
+            "DROP TABLE IF EXISTS albums_new;",
+            """
+            CREATE TABLE albums_new (
+              sk INTEGER PRIMARY KEY,
+              id TEXT NOT NULL UNIQUE,
+              album TEXT,
+              total_tracks INTEGER,
+              release_date DATE
+            );""",
+            """
+            INSERT INTO albums_new (id, album, total_tracks, release_date)
+            SELECT id, album, total_tracks, release_date FROM albums;""",
+            """
+            CREATE TABLE artists_new (
+              sk INTEGER PRIMARY KEY,
+              id TEXT NOT NULL UNIQUE,
+              artist TEXT NOT NULL,
+              genres TEXT   -- JSON array
+            );""",
+            """
+            INSERT INTO artists_new (id, artist, genres)
+            SELECT id, artist, genres FROM artists;""",
+            """
+            CREATE TABLE tracks_new (
+              sk INTEGER PRIMARY KEY,
+              id TEXT NOT NULL UNIQUE,
+              track TEXT NOT NULL,
+              album_sk INTEGER,
+              duration_ms INTEGER NOT NULL,
+              track_number INTEGER,
+
+              FOREIGN KEY (album_sk) REFERENCES albums(sk) ON DELETE CASCADE
+            );""",
+            """
+            INSERT INTO tracks_new (id, track, album_sk, duration_ms, track_number)
+            SELECT t.id, t.track, a.sk, t.duration_ms, t.track_number
+            FROM tracks t LEFT JOIN albums_new a ON a.id = t.album_id;""",
+            """
+            CREATE TABLE track_artists_new (
+              track_sk INTEGER NOT NULL,
+              artist_sk INTEGER NOT NULL,
+              artist_order INTEGER NOT NULL,
+
+              PRIMARY KEY (track_sk, artist_sk),
+              FOREIGN KEY (track_sk) REFERENCES tracks(sk) ON DELETE CASCADE,
+              FOREIGN KEY (artist_sk) REFERENCES artists(sk) ON DELETE CASCADE
+            );""",
+            """
+            INSERT INTO track_artists_new (track_sk, artist_sk, artist_order)
+            SELECT t.sk, a.sk, ta.artist_order
+            FROM track_artists ta
+            JOIN tracks_new t ON t.id = ta.track_id
+            JOIN artists_new a ON a.id = ta.artist_id;""",
+            """
+            CREATE TABLE logs_new (
+              id INTEGER PRIMARY KEY AUTOINCREMENT,
+              track_sk INTEGER NOT NULL,
+              played_at TIMESTAMP NOT NULL,
+              context_type TEXT,
+              context_uri TEXT,
+
+              FOREIGN KEY (track_sk) REFERENCES tracks(sk) ON DELETE CASCADE,
+              UNIQUE (track_sk, played_at)
+            );""",
+            """
+            INSERT INTO logs_new (id, track_sk, played_at, context_type, context_uri)
+            SELECT l.id, t.sk, l.played_at, l.context_type, l.context_uri
+            FROM logs l JOIN tracks_new t ON t.id = l.track_id;""",
+            "DROP TABLE logs;",
+            "DROP TABLE track_artists;",
+            "DROP TABLE tracks;",
+            "DROP TABLE artists;",
+            "DROP TABLE albums;",
+            "ALTER TABLE albums_new RENAME TO albums;",
+            "ALTER TABLE artists_new RENAME TO artists;",
+            "ALTER TABLE tracks_new RENAME TO tracks;",
+            "ALTER TABLE track_artists_new RENAME TO track_artists;",
+            "ALTER TABLE logs_new RENAME TO logs;",
+            # index 跟著舊表被 drop 了，重建
+            "CREATE INDEX IF NOT EXISTS idx_artists_genres_null ON artists(id) WHERE genres IS NULL;",
+            "CREATE INDEX IF NOT EXISTS idx_logs_played_at ON logs (played_at);",
+            "CREATE INDEX IF NOT EXISTS idx_track_artists_artist_sk ON track_artists (artist_sk);",
+        ],
+    },
+    {
+        # sqlite 沒有 WAL-logged / unlogged 之分
+        "version": 5,
+        "name": "unlogged_cache",
+        "concurrent": False,
+        "statements": [],
+    },
+    {
+        # 每次 flush / 更新 genres 就 +1，讀取端 (read_api.py) 用它判斷快取是否過期
+        "version": 6,
+        "name": "flush_generation",
+        "concurrent": False,
+        "statements": [
+            """
+            CREATE TABLE IF NOT EXISTS flush_generation (
+              id INTEGER NOT NULL PRIMARY KEY CHECK (id = 1),   -- 只有一列
+              generation INTEGER NOT NULL DEFAULT 0
+            );""",
+            "INSERT INTO flush_generation (id, generation) VALUES (1, 0) ON CONFLICT (id) DO NOTHING;",
+        ],
+    },
+    {
+        # now-playing sampler (sampler.py) 的播放片段，一個片段一列 (只存起訖，不存每次輪詢)
+        # 不加 FK，原因同 postgres
+        "version": 7,
+        "name": "play_segments",
+        "mode": "text",
+        "concurrent": False,
+        "statements": [
+            """
+            CREATE TABLE IF NOT EXISTS play_segments (
+              track_id TEXT NOT NULL,
+              started_at TIMESTAMP NOT NULL,
+              ended_at TIMESTAMP NOT NULL,
+              progress_start_ms INTEGER NOT NULL,
+              progress_end_ms INTEGER NOT NULL,
+              end_reason TEXT NOT NULL,   -- completed / skipped / seeked / paused / stopped
+
+              PRIMARY KEY (track_id, started_at)
+            );""",
+        ],
+    },
+    {
+        # surrogate 模式的 play_segments: 同 postgres，先確保有 text 版的表，再建新表搬資料
+        # 先清掉舊版 runner 失敗時可能留下的 play_segments_new
+        "version": 8,
+        "name": "play_segments_surrogate",
+        "mode": "surrogate",
+        "concurrent": False,
+        "statements": [
+            "DROP TABLE IF EXISTS play_segments_new;",
+            """
+            CREATE TABLE IF NOT EXISTS play_segments (
+              track_id TEXT NOT NULL,
+              started_at TIMESTAMP NOT NULL,
+              ended_at TIMESTAMP NOT NULL,
+              progress_start_ms INTEGER NOT NULL,
+              progress_end_ms INTEGER NOT NULL,
+              end_reason TEXT NOT NULL,
+
+              PRIMARY KEY (track_id, started_at)
+            );""",
+            """
+            CREATE TABLE play_segments_new (
+              track_sk INTEGER NOT NULL,
+              started_at TIMESTAMP NOT NULL,
+              ended_at TIMESTAMP NOT NULL,
+              progress_start_ms INTEGER NOT NULL,
+              progress_end_ms INTEGER NOT NULL,
+              end_reason TEXT NOT NULL,
+
+              PRIMARY KEY (track_sk, started_at),
+              FOREIGN KEY (track_sk) REFERENCES tracks(sk) ON DELETE CASCADE
+            );""",
+            """
+            INSERT INTO play_segments_new (track_sk, started_at, ended_at, progress_start_ms, progress_end_ms, end_reason)
+            SELECT t.sk, s.started_at, s.ended_at, s.progress_start_ms, s.progress_end_ms, s.end_reason
+            FROM play_segments s JOIN tracks t ON t.id = s.track_id;""",
+            "DROP TABLE play_segments;",
+            "ALTER TABLE play_segments_new RENAME TO play_segments;",
+        ],
+    },
+]
+
+
+MIGRATIONS = {
+    'supabase': POSTGRES_MIGRATIONS,
+    'sqlite': SQLITE_MIGRATIONS,
+}
+
+
+def get_applied_versions() -> set:
+    """回傳 DB 已套用的 migration version，還沒有 schema_version table 時回傳空 set"""
+    try:
+        with get_db_connection() as conn:
+            return {row[0] for row in conn.execute(text("SELECT version FROM schema_version"))}
+
+    except (OperationalError, ProgrammingError):
+        # 第一次執行: 還沒有 schema_version table。table 存在的話就是別的錯誤
+        if inspect(get_db_engine()).has_table('schema_version'):
+            raise
+        return set()
+
+
+def migrate(db_type = None, schema_mode = None) -> int:
+    """
+    套用尚未執行的 migration，回傳目前最新的 schema 版本
+    已是最新版本時只會送一個 SELECT
+    """
+    config = get_config()
+    if db_type is None:
+        db_type = config['db_type']
+    if schema_mode is None:
+        schema_mode = config['schema_mode']
+    migrations = MIGRATIONS[db_type]
+
+    applied = get_applied_versions()
+
+    # 已經轉成 surrogate 的 DB 不能再改回 text (text 模式的 migration 套用過之後仍可以轉成 surrogate)
+    for m in migrations:
+        if m["version"] in applied and m.get("mode") == "surrogate" and schema_mode != "surrogate":
+            raise RuntimeError(
+                f"DB 已套用 migration {m['version']} ({m['name']})，為 '{m['mode']}' 模式，"
+                f"但目前 SCHEMA_MODE 是 '{schema_mode}'"
+            )
+
+    pending = [
+        m for m in migrations
+        if m["version"] not in applied and m.get("mode") in (None, schema_mode)
+    ]
+    if not pending:
+        return max(applied)
+
+    engine = get_db_engine()
+    try:
+        with engine.begin() as conn:
+            conn.execute(text(SCHEMA_VERSION_DDL))
+
+        for m in pending:
+            if m["concurrent"]:
+                # CREATE INDEX CONCURRENTLY 不能在 transaction 內執行
+                with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+                    for stmt in m["statements"]:
+                        _drop_invalid_index(conn, stmt)
+                        conn.execute(text(stmt))
+                with engine.begin() as conn:
+                    _record_version(conn, m)
+            else:
+                with engine.begin() as conn:
+                    for stmt in m["statements"]:
+                        conn.execute(text(stmt))
+                    _record_version(conn, m)
+            print(f"   套用 migration {m['version']}: {m['name']}")
+
+    except Exception as e:
+        print(f"執行 migration 發生錯誤: {e}")
+        raise
+
+    return max(applied | {m["version"] for m in pending})
+
+
+def _drop_invalid_index(conn, stmt):
+    """
+    CREATE INDEX CONCURRENTLY 中途失敗會留下 INVALID index，IF NOT EXISTS 會直接略過它，
+    所以重跑前先檢查 pg_index.indisvalid，INVALID 就 drop 掉重建
+    """
+    match = CONCURRENT_INDEX_RE.match(stmt)
+    if not match:
+        return
+    name = match.group(1)
+    valid = conn.execute(
+        text("SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass(:name)"),
+        {"name": name}
+    ).scalar()
+    if valid is False:
+        print(f"   index {name} 為 INVALID (上次建立失敗)，drop 後重建")
+        conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {name};"))
+
+
+def _record_version(conn, migration):
+    conn.execute(
+        text("INSERT INTO schema_version (version, name) VALUES (:version, :name) ON CONFLICT (version) DO NOTHING"),
+        {"version": migration["version"], "name": migration["name"]}
+    )
@@ -0,0 +1,193 @@
+"""
+聆聽統計的唯讀 HTTP API，給 dashboard 等使用，不用每次 view 都直接查 supabase。
+
+    python -m spotify_log.read_api        # 預設 http://127.0.0.1:8000 (READ_API_HOST / READ_API_PORT 可改)
+
+    GET /stats/top-tracks?days=30&limit=10
+    GET /stats/top-artists?days=30&limit=10
+    GET /stats/top-genres?days=30&limit=10
+    GET /stats/recent?limit=20
+    GET /stats/totals?days=30              (days 省略 = 全部時間)
+
+快取:
+  - 資料只會在 flush 時改變。insert_data_from_df 每次 flush 會把 flush_generation +1，
+    這裡最多每 GENERATION_TTL 秒向 DB 確認一次 generation，變了就整個快取作廢
+  - 查詢結果 (已轉好的 JSON bytes) 放在記憶體 LRU，另外有 CACHE_TTL 上限
+  - 回應帶 ETag (generation + 查詢內容；有 days 時再加上時間 bucket)，client 帶相同的 If-None-Match 時直接回 304
+  - 所有查詢共用 config.get_db_engine() 的連線池
+"""
+import http.server
+import urllib.parse
+import hashlib, json, os, threading, time
+from collections import OrderedDict
+
+from spotify_log import db_utils
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8000
+
+CACHE_SIZE = 256        # 最多快取幾個查詢結果
+CACHE_TTL = 300         # 秒; generation 沒變的話，結果最多保留多久
+GENERATION_TTL = 10     # 秒; 多久向 DB 確認一次 flush_generation
+MAX_LIMIT = 100
+
+# path -> (查詢函數, 可接受的 query 參數)
+ENDPOINTS = {
+    "/stats/top-tracks": (db_utils.get_top_tracks, ("days", "limit")),
+    "/stats/top-artists": (db_utils.get_top_artists, ("days", "limit")),
+    "/stats/top-genres": (db_utils.get_top_genres, ("days", "limit")),
+    "/stats/recent": (db_utils.get_recent_plays, ("limit",)),
+    "/stats/totals": (db_utils.get_totals, ("days",)),
+}
+
+
+class TTLCache:
+    """有 TTL 的 LRU 快取 (thread-safe)"""
+
+    def __init__(self, maxsize = CACHE_SIZE, ttl = CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()   # key -> (存入時間, value)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            stored_at, value = item
+            if time.monotonic() - stored_at > self.ttl:
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last = False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+class StatsService:
+    """查詢 + 快取。HTTP 以外 (e.g., 直接在 python 裡) 也可以單獨使用"""
+
+    def __init__(self, cache_size = CACHE_SIZE, ttl = CACHE_TTL, generation_ttl = GENERATION_TTL):
+        self.cache = TTLCache(cache_size, ttl)
+        self.generation_ttl = generation_ttl
+        self._generation = None
+        self._generation_checked_at = None
+        self._lock = threading.Lock()
+
+    def generation(self) -> int:
+        """目前的 flush_generation，最多每 generation_ttl 秒查一次 DB"""
+        now = time.monotonic()
+        with self._lock:
+            if self._generation_checked_at is not None and now - self._generation_checked_at < self.generation_ttl:
+                return self._generation
+
+        generation = db_utils.get_flush_generation()
+        with self._lock:
+            if generation != self._generation:
+                # 舊 generation 的 key 不會再被用到，直接清掉
+                self.cache.clear()
+            self._generation = generation
+            self._generation_checked_at = now
+        return generation
+
+    def etag(self, path: str, params: dict, generation: int) -> str:
+        """
+        generation + 查詢內容。有 days 的查詢時間窗會隨時間往前移，沒有 flush 時結果也會變，
+        所以再加上以 CACHE_TTL 為單位的時間 bucket，最多 ttl 秒就換一個 ETag (快取也跟著重查)
+        """
+        bucket = int(time.time() // self.cache.ttl) if "days" in params else None
+        key = json.dumps([path, params, bucket], sort_keys = True)
+        return f'"{generation}-{hashlib.sha1(key.encode()).hexdigest()[:16]}"'
+
+    def get(self, path: str, params: dict, etag: str) -> bytes:
+        """回傳 JSON bytes，快取沒有才查 DB"""
+        body = self.cache.get(etag)
+        if body is None:
+            func, _ = ENDPOINTS[path]
+            body = json.dumps(func(**params), ensure_ascii = False).encode()
+            self.cache.set(etag, body)
+        return body
+
+
+def parse_params(path: str, query: str) -> dict:
+    """把 query string 轉成查詢函數的參數，不合法時丟 ValueError"""
+    _, allowed = ENDPOINTS[path]
+    qs = urllib.parse.parse_qs(query)
+
+    params = {}
+    for name in allowed:
+        if name not in qs:
+            continue
+        value = int(qs[name][0])
+        if name == "days" and value <= 0:
+            raise ValueError("days 必須大於 0")
+        if name == "limit":
+            value = max(1, min(value, MAX_LIMIT))
+        params[name] = value
+    return params
+
+
+class StatsHandler(http.server.BaseHTTPRequestHandler):
+    service = StatsService()
+
+    def do_GET(self):
+        parsed = urllib.parse.urlparse(self.path)
+        if parsed.path not in ENDPOINTS:
+            return self._send(404, b'{"error": "not found"}')
+
+        try:
+            params = parse_params(parsed.path, parsed.query)
+        except ValueError as e:
+            return self._send(400, json.dumps({"error": f"invalid parameter: {e}"}).encode())
+
+        try:
+            generation = self.service.generation()
+            etag = self.service.etag(parsed.path, params, generation)
+            if self.headers.get("If-None-Match") == etag:
+                return self._send(304, None, etag)
+            body = self.service.get(parsed.path, params, etag)
+
+        except Exception as e:
+            print(f"read api 查詢發生錯誤: {e}")
+            return self._send(500, b'{"error": "internal error"}')
+
+        self._send(200, body, etag)
+
+    def _send(self, status, body, etag = None):
+        self.send_response(status)
+        if etag:
+            self.send_header("ETag", etag)
+            # client 每次都要用 ETag 確認，資料沒變就回 304
+            self.send_header("Cache-Control", "no-cache")
+        if body is not None:
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if body is not None:
+            self.wfile.write(body)
+
+    # 靜音 log
+    def log_message(self, fmt, *args):
+        return
+
+
+def serve(host = None, port = None):
+    host = host or os.getenv("READ_API_HOST", DEFAULT_HOST)
+    port = int(port or os.getenv("READ_API_PORT", DEFAULT_PORT))
+    with http.server.ThreadingHTTPServer((host, port), StatsHandler) as httpd:
+        print(f"read api: http://{host}:{port}")
+        httpd.serve_forever()
+
+
+if __name__ == "__main__":
+    serve()
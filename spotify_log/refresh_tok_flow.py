@@ -33,9 +33,8 @@ def get_spotify_items(url, access_token):
     return j.get("next"), j["items"]
 
 
-def fetch_recently_played(refresh_token):
-    tok = refresh_access_token(refresh_token)
-    access_token, refresh_token = tok["access_token"], tok["refresh_token"]
+def fetch_recently_played(tok):
+    access_token = tok["access_token"]
     items, next_url = [], "https://api.spotify.com/v1/me/player/recently-played"
     
     while next_url:
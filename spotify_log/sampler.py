@@ -0,0 +1,287 @@
+"""
+高解析度的 now-playing sampler (選用)。
+recently-played 只記錄播完的歌；這裡輪詢 currently-playing，可以記到跳過、部分播放、暫停。
+
+    python -m spotify_log.sampler    # Ctrl+C 結束，結束前會把還沒寫入的片段寫進 DB
+
+- 輪詢結果在記憶體合併成播放片段 (segment)，只把片段的起訖寫進 play_segments，不存每次輪詢的結果
+- 依 progress / duration 預測播放狀態: 輪詢結果跟預測一致 (沒換歌、沒暫停、沒拖曳) 就把下次間隔加倍，
+  最多到 SAMPLER_MAX_INTERVAL，且不超過預測的歌曲結束時間；有變化就回到 SAMPLER_INTERVAL。
+  沒在播放時間隔也會逐步拉長。API 呼叫次數跟聆聽事件成正比，而不是跟時間成正比
+- 所有請求共用一個 requests.Session (keep-alive)
+
+需要 user-read-currently-playing 權限。舊的 env/token.json 沒有這個 scope，要刪掉重新授權一次
+"""
+import os, time
+import requests
+import pandas as pd
+
+from config import get_config
+from spotify_log import db_utils, enrich, migrations
+from spotify_log.parser import parse_track
+
+CURRENTLY_PLAYING_URL = "https://api.spotify.com/v1/me/player/currently-playing"
+
+# 輪詢間隔 (秒，可用 SAMPLER_INTERVAL / SAMPLER_MAX_INTERVAL 覆寫):
+# 換歌 / 暫停後用 INTERVAL，播放狀態跟預測一致時逐步拉長到 MAX_INTERVAL
+DEFAULT_INTERVAL = 15
+DEFAULT_MAX_INTERVAL = 120
+
+END_MARGIN = 2           # 秒; 預測的歌曲結束後多等一下再輪詢，確保已經換到下一首
+TOLERANCE_MS = 3000      # progress 跟預測差多少以內算一致
+FLUSH_SEGMENTS = 20      # 累積幾個片段寫一次 DB (停止播放時也會寫)
+MAX_AUTH_FAILURES = 2    # 連續幾次 401 就放棄 (通常是 token 缺少 scope)
+
+SEGMENT_COLUMNS = ["track_id", "started_at", "ended_at", "progress_start_ms", "progress_end_ms", "end_reason"]
+
+
+class NowPlayingSampler:
+    """
+    get_token: 回傳 token dict (access_token, expires_in, got_at)，e.g., auth_code_flow.get_valid_token
+    """
+
+    def __init__(self, get_token, interval = DEFAULT_INTERVAL, max_interval = DEFAULT_MAX_INTERVAL, flush_segments = FLUSH_SEGMENTS, session = None):
+        self.get_token = get_token
+        self.interval = interval
+        self.max_interval = max_interval
+        self.flush_segments = flush_segments
+        self.session = session or requests.Session()
+
+        self.tok = None
+        self.current = None      # 進行中的片段
+        self.closed = []         # 已結束、還沒寫進 DB 的片段
+        self.wait = interval     # 目前的輪詢間隔 (秒)
+        self.last_poll_at = None
+        self.paused = None       # 最後一次看到暫停中的 (track_id, progress_ms)
+        self.polls = 0
+
+    # ---------- API ----------
+    def _access_token(self):
+        if self.tok is None or time.time() > self.tok["got_at"] + self.tok["expires_in"] - 120:
+            self.tok = self.get_token()
+        return self.tok["access_token"]
+
+    def poll(self):
+        """
+        呼叫一次 currently-playing
+        Return {"item", "context", "is_playing", "progress_ms"}；沒有在播放歌曲 (204、廣告、podcast、本機檔案) 時回傳 None
+        """
+        auth_failures = 0
+        while True:
+            self.polls += 1
+            r = self.session.get(CURRENTLY_PLAYING_URL, timeout = 30,
+                                 headers = {"Authorization": f"Bearer {self._access_token()}"})
+
+            if r.status_code == 401:
+                auth_failures += 1
+                if auth_failures >= MAX_AUTH_FAILURES:
+                    raise PermissionError("currently-playing 一直回傳 401，token 可能缺少 user-read-currently-playing scope，請刪除 env/token.json 重新授權")
+                self.tok = None   # 重新取得
+                continue
+            if r.status_code == 429:
+                retry_after = int(r.headers.get("Retry-After", self.interval))
+                print(f"sampler 被限流，{retry_after}s 後重試")
+                time.sleep(retry_after)
+                continue
+            break
+
+        if r.status_code == 204:
+            return None
+        r.raise_for_status()
+
+        j = r.json()
+        item = j.get("item")
+        if j.get("currently_playing_type") != "track" or not item or item.get("is_local") or not item.get("id"):
+            return None
+        return {
+            "item": item,
+            "context": j.get("context"),
+            "is_playing": j.get("is_playing", False),
+            "progress_ms": j.get("progress_ms") or 0,
+        }
+
+    # ---------- 片段 ----------
+    def observe(self, sample, now: pd.Timestamp) -> float:
+        """
+        把一次輪詢結果併進片段，回傳距離下次輪詢的秒數
+        now: 這次輪詢的時間 (UTC)
+        """
+        since_last_ms = None if self.last_poll_at is None else (now - self.last_poll_at).total_seconds() * 1000
+        self.last_poll_at = now
+        cur = self.current
+
+        # 1. 沒在播放
+        if sample is None or not sample["is_playing"]:
+            self.paused = None if sample is None else (sample["item"]["id"], sample["progress_ms"])
+            if cur is not None:
+                if sample is not None and sample["item"]["id"] == cur["track_id"]:
+                    # 暫停: 停在哪裡是已知的
+                    self._close(now, "paused", progress_end_ms = sample["progress_ms"])
+                else:
+                    self._close(now, "stopped")
+                self.wait = self.interval
+            else:
+                self.wait = min(self.wait * 2, self.max_interval)
+            return self.wait
+
+        item = sample["item"]
+        progress = sample["progress_ms"]
+        remaining = max(item["duration_ms"] - progress, 0) / 1000
+
+        # 2. 同一首歌，progress 跟預測一致: 延長片段，這次輪詢其實是多餘的 -> 間隔加倍
+        if cur is not None and cur["track_id"] == item["id"]:
+            predicted = cur["last_progress_ms"] + (now - cur["last_seen"]).total_seconds() * 1000
+            if abs(progress - predicted) <= TOLERANCE_MS:
+                cur["last_progress_ms"] = progress
+                cur["last_seen"] = now
+                self.wait = min(self.wait * 2, self.max_interval)
+                return min(self.wait, remaining + END_MARGIN)
+
+            # 同一首歌但 progress 跳掉 (拖曳、重播)
+            self._close(now, "seeked")
+
+        # 3. 換歌: 新的歌從 now - progress 開始播，上一首在那時結束
+        elif cur is not None:
+            self._close(now - pd.Timedelta(milliseconds = progress))
+
+        # 新片段。上次輪詢後才開始的歌，從頭開始算；否則最早只能推到上次輪詢
+        # 暫停後繼續的話，不會早於暫停時的 progress
+        progress_start = 0 if since_last_ms is None else max(0, int(progress - since_last_ms))
+        if self.paused is not None and self.paused[0] == item["id"] and self.paused[1] <= progress:
+            progress_start = max(progress_start, self.paused[1])
+        self.paused = None
+        self.current = {
+            "item": item,
+            "context": sample["context"],
+            "track_id": item["id"],
+            "started_at": now - pd.Timedelta(milliseconds = progress - progress_start),
+            "progress_start_ms": progress_start,
+            "last_progress_ms": progress,
+            "last_seen": now,
+        }
+        self.wait = self.interval
+        return min(self.wait, remaining + END_MARGIN)
+
+    def _close(self, ended_at: pd.Timestamp, end_reason = None, progress_end_ms = None):
+        """
+        結束目前的片段。兩次輪詢之間發生的事只能推算:
+          - 換歌 (end_reason 為 None): ended_at 是新歌開始的時間，從最後一次看到的 progress 推算到那時，
+            依推算結果判斷 completed / skipped
+          - 暫停: 停下的 progress 已知，從它推算暫停的時間
+          - 停止: 預測在 ended_at 之前就會播完的話算 completed，否則只能停在最後一次看到的時間
+          - 其他 (seeked): 停在最後一次看到的時間
+        """
+        cur = self.current
+        self.current = None
+        duration = cur["item"]["duration_ms"]
+        last_seen, last_progress = cur["last_seen"], cur["last_progress_ms"]
+        predicted_end = last_seen + pd.Timedelta(milliseconds = duration - last_progress)
+
+        if end_reason is None:
+            ended_at = max(ended_at, last_seen)
+            progress_end_ms = min(duration, int(last_progress + (ended_at - last_seen).total_seconds() * 1000))
+            end_reason = "completed" if progress_end_ms >= duration - TOLERANCE_MS else "skipped"
+
+        elif end_reason == "paused":
+            ended_at = min(ended_at, max(last_seen, last_seen + pd.Timedelta(milliseconds = progress_end_ms - last_progress)))
+
+        elif end_reason == "stopped" and predicted_end <= ended_at:
+            ended_at, progress_end_ms, end_reason = predicted_end, duration, "completed"
+
+        else:
+            ended_at, progress_end_ms = last_seen, last_progress
+
+        cur.update(
+            ended_at = max(ended_at, cur["started_at"]),
+            progress_end_ms = max(progress_end_ms, cur["progress_start_ms"]),
+            end_reason = end_reason,
+        )
+        self.closed.append(cur)
+
+    def flush(self):
+        """把已結束的片段寫進 DB，並補齊新 artist 的 genres"""
+        if not self.closed:
+            return
+
+        segments, self.closed = self.closed, []
+        df = pd.DataFrame([
+            parse_track({"track": s["item"], "played_at": s["started_at"], "context": s["context"]})
+            for s in segments
+        ])
+        df_segments = pd.DataFrame([{col: s[col] for col in SEGMENT_COLUMNS} for s in segments])
+
+        try:
+            inserted = db_utils.insert_play_segments(df, df_segments)
+        except Exception:
+            # 寫入失敗就留著下次再寫
+            self.closed = segments + self.closed
+            raise
+        print(f"寫入 {len(segments)} 個播放片段 (累計 API 呼叫 {self.polls} 次)")
+
+        if inserted.get("artists"):
+            enrich.enrich_inserted(inserted, self.tok)
+
+    # ---------- 主迴圈 ----------
+    def run(self, duration = None):
+        """持續輪詢直到 Ctrl+C (或 duration 秒後)"""
+        deadline = None if duration is None else time.time() + duration
+        try:
+            while deadline is None or time.time() < deadline:
+                now = pd.Timestamp.now(tz = "UTC")
+                try:
+                    sample = self.poll()
+                except requests.RequestException as e:
+                    print(f"sampler 呼叫 API 發生錯誤，{self.interval}s 後重試: {e}")
+                    time.sleep(self.interval)
+                    continue
+
+                wait = self.observe(sample, now)
+
+                # 片段夠多、或停止播放時寫入
+                if len(self.closed) >= self.flush_segments or (self.current is None and self.closed):
+                    try:
+                        self.flush()
+                    except Exception as e:
+                        print(f"寫入播放片段發生錯誤，下次再試: {e}")
+
+                time.sleep(wait)
+
+        except KeyboardInterrupt:
+            pass
+
+        finally:
+            # 還在播放的片段也寫進去
+            if self.current is not None:
+                self._close(self.current["last_seen"], "stopped")
+            self.flush()
+            self.session.close()
+
+
+def _env_seconds(name, default):
+    """
+    讀取秒數設定，沒設定或格式不對時用預設值
+    只在 sampler 裡讀，不放進 get_config: 設錯也不會影響 main.py 等其他流程
+    """
+    value = (os.getenv(name) or "").strip()
+    try:
+        seconds = float(value)
+    except ValueError:
+        if value:
+            print(f"{name}={value!r} 不是有效的秒數，改用預設值 {default}")
+        return default
+    if seconds <= 0:
+        print(f"{name} 必須大於 0，改用預設值 {default}")
+        return default
+    return seconds
+
+
+if __name__ == "__main__":
+    from spotify_log import auth_code_flow
+
+    get_config()   # 載入 env/.env、檢查必要設定
+    migrations.migrate()
+    NowPlayingSampler(
+        auth_code_flow.get_valid_token,
+        interval = _env_seconds("SAMPLER_INTERVAL", DEFAULT_INTERVAL),
+        max_interval = _env_seconds("SAMPLER_MAX_INTERVAL", DEFAULT_MAX_INTERVAL),
+    ).run()
@@ -0,0 +1,368 @@
+"""
+儲存後端介面。
+db_utils 只負責流程 (判斷 buffer、拆表、flush)，實際的 SQL 差異都收在這裡。
+(schema 的建立與變更在 migrations.py)
+目前有兩種實作：
+  - PostgresBackend: supabase (遠端 PostgreSQL)
+  - SQLiteBackend:   本地嵌入式 SQLite, 不需網路，方便本地分析、benchmark
+由 config 的 db_type 決定使用哪一個 (get_backend)
+
+schema_mode = surrogate 時 (見 config.py)，寫入前會用 IdDictionary 把 spotify id 轉成 integer sk，
+db_utils 不需要知道目前是哪種模式。
+"""
+import json
+from functools import partial
+import pandas as pd
+from sqlalchemy import text, bindparam, column
+
+from config import get_config
+
+# upsert 時的衝突欄位 (兩種後端共用，確保語意一致: 重覆資料直接略過)
+CONFLICT_COLUMNS = {
+    'albums': ['id'],
+    'artists': ['id'],
+    'tracks': ['id'],
+    'track_artists': ['track_id', 'artist_id'],
+    'logs': ['track_id', 'played_at'],
+    'play_segments': ['track_id', 'started_at'],
+}
+
+# surrogate 模式: dimension tables 仍用 spotify id 判斷衝突，children 改用 sk
+SURROGATE_CONFLICT_COLUMNS = {
+    **CONFLICT_COLUMNS,
+    'track_artists': ['track_sk', 'artist_sk'],
+    'logs': ['track_sk', 'played_at'],
+    'play_segments': ['track_sk', 'started_at'],
+}
+
+# surrogate 模式: 有 integer sk 的 dimension tables
+DIMENSION_TABLES = ['albums', 'artists', 'tracks']
+
+# surrogate 模式: children 的 spotify id 欄位 -> (對應的 dimension table, 取代它的 sk 欄位)
+SURROGATE_FOREIGN_KEYS = {
+    'tracks': {'album_id': ('albums', 'album_sk')},
+    'track_artists': {'track_id': ('tracks', 'track_sk'), 'artist_id': ('artists', 'artist_sk')},
+    'logs': {'track_id': ('tracks', 'track_sk')},
+    'play_segments': {'track_id': ('tracks', 'track_sk')},
+}
+
+# cache 中存成 array 的欄位
+ARRAY_COLUMNS = ['artist', 'artist_id']
+
+# 讀取用的 join 條件 (別名: l = logs, t = tracks, al = albums, ta = track_artists, ar = artists)
+TEXT_JOINS = {
+    'logs_tracks': 't.id = l.track_id',
+    'tracks_albums': 'al.id = t.album_id',
+    'tracks_track_artists': 'ta.track_id = t.id',
+    'track_artists_artists': 'ar.id = ta.artist_id',
+}
+SURROGATE_JOINS = {
+    'logs_tracks': 't.sk = l.track_sk',
+    'tracks_albums': 'al.sk = t.album_sk',
+    'tracks_track_artists': 'ta.track_sk = t.sk',
+    'track_artists_artists': 'ar.sk = ta.artist_sk',
+}
+
+
+class IdDictionary:
+    """
+    spotify id -> integer sk 的 in-process 對照表 (surrogate 模式用)。
+    flush 時每個 dimension table upsert 完，只對還沒看過的 id 送一個批次 SELECT 取回 sk；
+    同一個 process 內之後的 flush 直接查 dict，不用再問 DB。
+    """
+
+    # 每次 SELECT ... IN 的 id 數量上限 (sqlite 有 bind 參數數量限制)
+    CHUNK_SIZE = 1000
+
+    def __init__(self):
+        self._maps = {table: {} for table in DIMENSION_TABLES}
+
+    def clear(self):
+        """交易 rollback 後呼叫，避免留下不存在於 DB 的 sk"""
+        for m in self._maps.values():
+            m.clear()
+
+    def add(self, table_name: str, rows):
+        """記下剛 INSERT ... RETURNING id, sk 回來的 (id, sk)"""
+        self._maps[table_name].update(rows)
+
+    def resolve(self, conn, table_name: str, ids):
+        """確保 ids 都在對照表中 (批次向 DB 查詢缺少的部分)"""
+        mapping = self._maps[table_name]
+        missing = list({i for i in ids if i and i not in mapping})
+
+        stmt = text(f"SELECT id, sk FROM {table_name} WHERE id IN :ids").bindparams(
+            bindparam("ids", expanding=True)
+        )
+        for i in range(0, len(missing), self.CHUNK_SIZE):
+            rows = conn.execute(stmt, {"ids": missing[i:i + self.CHUNK_SIZE]})
+            mapping.update({row[0]: row[1] for row in rows})
+
+    def encode(self, table_name: str, df: pd.DataFrame) -> pd.DataFrame:
+        """把 df 中指向 dimension 的 spotify id 欄位換成 sk 欄位 (dimension 要先 resolve 過)"""
+        foreign_keys = SURROGATE_FOREIGN_KEYS.get(table_name)
+        if not foreign_keys:
+            return df
+
+        df = df.copy()
+        for id_col, (dim_table, sk_col) in foreign_keys.items():
+            df[sk_col] = df[id_col].map(self._maps[dim_table]).astype("Int64")
+            df = df.drop(columns = [id_col])
+        return df
+
+
+class StorageBackend:
+    """
+    儲存後端的共同介面。所有方法都接收一個已開啟交易的 conn (config.get_db_connection)，
+    交易範圍由呼叫端 (db_utils) 決定。
+    """
+
+    # 讀取時把 artists.genres 展開成一列一個 genre 的 SQL 片段 (各後端不同)
+    GENRES_JOIN = None
+    GENRE_COLUMN = None
+
+    def __init__(self, schema_mode = "text"):
+        self.schema_mode = schema_mode
+        if schema_mode == "surrogate":
+            self.ids = IdDictionary()
+            self.conflict_columns = SURROGATE_CONFLICT_COLUMNS
+            self.joins = SURROGATE_JOINS
+        else:
+            self.ids = None
+            self.conflict_columns = CONFLICT_COLUMNS
+            self.joins = TEXT_JOINS
+
+    def rollback(self):
+        """寫入的交易失敗時呼叫，丟掉這次交易中快取的狀態"""
+        if self.ids is not None:
+            self.ids.clear()
+
+    def get_watermark(self, conn):
+        """回傳 cache 中最新的 played_at (pd.Timestamp)，cache 為空時回傳 None"""
+        row = conn.execute(text("SELECT MAX(played_at) FROM cache")).fetchone()
+        if row is None or row[0] is None:
+            return None
+        return pd.Timestamp(row[0])
+
+    def read_buffer(self, conn) -> pd.DataFrame:
+        """讀取整個 cache table"""
+        raise NotImplementedError
+
+    def write_buffer(self, conn, df: pd.DataFrame):
+        """用 df 取代 cache table 的內容"""
+        raise NotImplementedError
+
+    def append_buffer(self, conn, df: pd.DataFrame):
+        """把 df 加進 cache table (不動既有的資料)"""
+        raise NotImplementedError
+
+    def upsert(self, conn, table_name: str, df: pd.DataFrame) -> set:
+        """
+        把 df 寫進 table_name，衝突 (conflict_columns) 的資料略過
+        dimension tables (albums / artists / tracks) 回傳這次真的新增的 spotify id (INSERT ... RETURNING)，其他回傳空 set
+        surrogate 模式下，df 中的 spotify id 外鍵會先換成 sk；dimension 寫入後把 sk 記進 IdDictionary
+        """
+        if self.ids is not None:
+            df = self.ids.encode(table_name, df)
+
+        returning = None
+        if table_name in DIMENSION_TABLES:
+            returning = ['id', 'sk'] if self.ids is not None else ['id']
+
+        inserted = self._upsert(conn, table_name, df, self.conflict_columns[table_name], returning)
+
+        if self.ids is not None and table_name in DIMENSION_TABLES:
+            # 新增的 sk 已經由 RETURNING 拿到，只剩原本就在 DB 裡的 id 需要查
+            self.ids.add(table_name, inserted)
+            self.ids.resolve(conn, table_name, df['id'])
+
+        return {row[0] for row in inserted}
+
+    def _upsert(self, conn, table_name: str, df: pd.DataFrame, conflict_columns: list, returning: list = None) -> list:
+        """寫入並回傳 RETURNING 的 rows (returning 為 None 時回傳空 list)"""
+        raise NotImplementedError
+
+    def bump_generation(self, conn):
+        """資料有變動 (flush、更新 genres) 時呼叫，讓讀取端的快取失效"""
+        conn.execute(text("UPDATE flush_generation SET generation = generation + 1 WHERE id = 1"))
+
+    def get_generation(self, conn) -> int:
+        return conn.execute(text("SELECT generation FROM flush_generation WHERE id = 1")).scalar() or 0
+
+    def get_artists_without_genres(self, conn, limit: int = None) -> list:
+        """genres 還是 NULL 的 artist id (走 idx_artists_genres_null)"""
+        if limit is None:
+            df = pd.read_sql("SELECT id FROM artists WHERE genres IS NULL", conn)
+        else:
+            df = pd.read_sql(text("SELECT id FROM artists WHERE genres IS NULL LIMIT :limit"), conn, params = {"limit": limit})
+        return df['id'].tolist()
+
+    def update_genres(self, conn, genres_df: pd.DataFrame):
+        """genres_df: columns = id, genres (list)"""
+        raise NotImplementedError
+
+
+# ========== PostgreSQL (supabase) ===========
+def postgres_upsert(table, conn, keys, data_iter, conflict_columns = None, returning = None, inserted = None):
+    from sqlalchemy.dialects.postgresql import insert
+    from sqlalchemy import MetaData, Table
+
+    data_dicts = [dict(zip(keys, row)) for row in data_iter]
+
+    if not data_dicts:
+        return 0
+
+    metadata = MetaData()
+    table_obj = Table(table.name, metadata, autoload_with = conn.engine)
+
+    stmt = insert(table_obj).values(data_dicts)
+    stmt = stmt.on_conflict_do_nothing(
+        index_elements = conflict_columns or CONFLICT_COLUMNS[table.name]
+    )
+
+    if returning:
+        # ON CONFLICT DO NOTHING 時，RETURNING 只會回傳真的新增的 rows
+        stmt = stmt.returning(*[table_obj.c[col] for col in returning])
+        inserted.extend(tuple(row) for row in conn.execute(stmt))
+    else:
+        conn.execute(stmt)
+
+    return len(data_dicts)
+
+
+class PostgresBackend(StorageBackend):
+
+    GENRES_JOIN = "CROSS JOIN LATERAL unnest(ar.genres) AS g(genre)"
+    GENRE_COLUMN = "g.genre"
+
+    def read_buffer(self, conn):
+        return pd.read_sql("SELECT * FROM cache ORDER BY played_at DESC", conn)
+
+    def write_buffer(self, conn, df):
+        # cache 是 UNLOGGED (migration 5)，DELETE 不寫 heap WAL；只有約 50 筆，也比 TRUNCATE 便宜
+        # (TRUNCATE 會換 relfilenode、重建 init fork 並 fsync，還要拿 ACCESS EXCLUSIVE lock，等於每次 flush 做一次 DDL)
+        conn.execute(text("DELETE FROM cache"))
+        self.append_buffer(conn, df)
+
+    def append_buffer(self, conn, df):
+        df.to_sql("cache", conn, if_exists="append", index=False)
+
+    def _upsert(self, conn, table_name, df, conflict_columns, returning = None):
+        inserted = []
+        method = partial(postgres_upsert, conflict_columns = conflict_columns, returning = returning, inserted = inserted)
+        df.to_sql(table_name, conn, if_exists="append", index=False, method = method)
+        return inserted
+
+    # 每個 UPDATE 帶的 artist 數量
+    GENRES_CHUNK_SIZE = 500
+
+    def update_genres(self, conn, genres_df):
+        # 用 unnest 把兩個 array 展開成一張虛擬表，一個 UPDATE 更新一整批，不用建臨時表
+        # 每個 artist 的 genres 長度不一，不能組成二維 array，所以先轉成 jsonb 再展開回 text[]
+        stmt = text("""
+            UPDATE artists AS a
+            SET genres = ARRAY(SELECT jsonb_array_elements_text(g.genres))
+            FROM unnest(CAST(:ids AS text[]), CAST(:genres AS jsonb[])) AS g(id, genres)
+            WHERE a.id = g.id
+        """)
+        ids = genres_df['id'].tolist()
+        genres = [json.dumps(list(g), ensure_ascii=False) for g in genres_df['genres']]
+
+        for i in range(0, len(ids), self.GENRES_CHUNK_SIZE):
+            conn.execute(stmt, {
+                "ids": ids[i:i + self.GENRES_CHUNK_SIZE],
+                "genres": genres[i:i + self.GENRES_CHUNK_SIZE],
+            })
+
+
+# ========== SQLite (本地嵌入式) ===========
+# SQLite 沒有 array 型別，array 欄位 (cache 的 artist / artist_id, artists.genres) 存成 JSON 字串
+
+def sqlite_upsert(table, conn, keys, data_iter, conflict_columns = None, returning = None, inserted = None):
+    from sqlalchemy.dialects.sqlite import insert
+
+    data_dicts = [dict(zip(keys, row)) for row in data_iter]
+
+    if not data_dicts:
+        return 0
+
+    stmt = insert(table.table).on_conflict_do_nothing(
+        index_elements = conflict_columns or CONFLICT_COLUMNS[table.name]
+    )
+
+    if returning:
+        # sk 不在 pandas 建的 table 物件裡，用 column() 直接指定欄位名稱
+        stmt = stmt.returning(*[column(col) for col in returning])
+        inserted.extend(tuple(row) for row in conn.execute(stmt, data_dicts))
+    else:
+        conn.execute(stmt, data_dicts)
+
+    return len(data_dicts)
+
+
+def _dump_json_columns(df: pd.DataFrame, columns) -> pd.DataFrame:
+    df = df.copy()
+    for col in columns:
+        df[col] = df[col].map(lambda v: None if v is None else json.dumps(list(v), ensure_ascii=False))
+    return df
+
+
+def _load_json_columns(df: pd.DataFrame, columns) -> pd.DataFrame:
+    for col in columns:
+        df[col] = df[col].map(lambda v: None if v is None else json.loads(v))
+    return df
+
+
+class SQLiteBackend(StorageBackend):
+
+    GENRES_JOIN = "JOIN json_each(ar.genres) AS g"
+    GENRE_COLUMN = "g.value"
+
+    def read_buffer(self, conn):
+        cache = pd.read_sql("SELECT * FROM cache ORDER BY played_at DESC", conn)
+        return _load_json_columns(cache, ARRAY_COLUMNS)
+
+    def write_buffer(self, conn, df):
+        conn.execute(text("DELETE FROM cache"))
+        self.append_buffer(conn, df)
+
+    def append_buffer(self, conn, df):
+        _dump_json_columns(df, ARRAY_COLUMNS).to_sql("cache", conn, if_exists="append", index=False)
+
+    def _upsert(self, conn, table_name, df, conflict_columns, returning = None):
+        inserted = []
+        method = partial(sqlite_upsert, conflict_columns = conflict_columns, returning = returning, inserted = inserted)
+        df.to_sql(table_name, conn, if_exists="append", index=False, method = method)
+        return inserted
+
+    def update_genres(self, conn, genres_df):
+        if genres_df.empty:
+            return
+        genres_df = _dump_json_columns(genres_df, ['genres'])
+        conn.execute(
+            text("UPDATE artists SET genres = :genres WHERE id = :id"),
+            genres_df[['id', 'genres']].to_dict('records')
+        )
+
+
+BACKENDS = {
+    'supabase': PostgresBackend,
+    'sqlite': SQLiteBackend,
+}
+
+
+# 同一個 process 共用 backend (IdDictionary 等快取才能跨 flush 保留)
+_backends = {}
+
+
+def get_backend(db_type = None, schema_mode = None) -> StorageBackend:
+    """依 db_type、schema_mode (預設從 config 取得) 回傳對應的儲存後端"""
+    if db_type is None or schema_mode is None:
+        config = get_config()
+        db_type = db_type or config['db_type']
+        schema_mode = schema_mode or config['schema_mode']
+
+    key = (db_type, schema_mode)
+    if key not in _backends:
+        _backends[key] = BACKENDS[db_type](schema_mode)
+    return _backends[key]
@@ -0,0 +1,102 @@
+"""
+合成的聆聽紀錄，給壓力測試 (bench_flush.py) 用。
+先做出假的 Spotify track objects，再丟給 parse_track，所以欄位、型別跟真的 API 資料完全一樣。
+
+  - 曲目熱門度是 Zipf 分布 (少數歌播很多次)，artist 熱門度也是
+  - 一首歌 1~3 位 artist，同一張專輯多首歌 (主要 artist 相同)
+  - 少數專輯的 release_date 只有年份 (真實 API 也會這樣)
+"""
+import string
+import numpy as np
+import pandas as pd
+
+from spotify_log.parser import parse_track
+
+ID_CHARS = np.array(list(string.ascii_letters + string.digits))
+ARTIST_COUNT_P = [0.75, 0.2, 0.05]   # 一首歌 1 / 2 / 3 位 artist 的機率
+ALBUM_SIZE = (8, 15)                 # 每張專輯幾首歌 (min, max)
+CONTEXT_TYPES = ["playlist", "album", "artist", None]
+CONTEXT_P = [0.5, 0.25, 0.1, 0.15]
+
+
+def _ids(rng, n, prefix = ""):
+    """n 個不重覆、22 字元的 base62 id (跟 spotify id 同長度)"""
+    body = ["".join(chars) for chars in rng.choice(ID_CHARS, size = (n, 22 - len(prefix)))]
+    ids = list(dict.fromkeys(prefix + b for b in body))
+    while len(ids) < n:   # 幾乎不會發生
+        ids = list(dict.fromkeys(ids + _ids(rng, n - len(ids), prefix)))
+    return ids
+
+
+def _zipf_p(n, s):
+    p = 1.0 / np.arange(1, n + 1) ** s
+    return p / p.sum()
+
+
+def make_catalog(n_tracks = 5000, n_artists = None, seed = 0, zipf_s = 1.1) -> list:
+    """回傳 n_tracks 個 spotify track object (dict)，順序即熱門度排名"""
+    rng = np.random.default_rng(seed)
+    n_artists = n_artists or max(1, n_tracks // 8)
+
+    artists = [{"id": i, "name": f"Artist {k}"} for k, i in enumerate(_ids(rng, n_artists))]
+    artist_p = _zipf_p(n_artists, zipf_s)
+
+    # 專輯: 先決定每張的曲數，湊滿 n_tracks
+    sizes = []
+    while sum(sizes) < n_tracks:
+        sizes.append(int(rng.integers(ALBUM_SIZE[0], ALBUM_SIZE[1] + 1)))
+    sizes[-1] -= sum(sizes) - n_tracks
+    album_ids = _ids(rng, len(sizes))
+    track_ids = _ids(rng, n_tracks)
+
+    tracks = []
+    for a, (album_id, size) in enumerate(zip(album_ids, sizes)):
+        main_artist = int(rng.choice(n_artists, p = artist_p))
+        year = int(rng.integers(1960, 2026))
+        release_date = str(year) if rng.random() < 0.05 else f"{year}-{rng.integers(1, 13):02d}-{rng.integers(1, 29):02d}"
+        album = {"id": album_id, "name": f"Album {a}", "total_tracks": size, "release_date": release_date}
+
+        for number in range(1, size + 1):
+            n_feat = rng.choice(len(ARTIST_COUNT_P), p = ARTIST_COUNT_P)
+            feats = [int(x) for x in rng.choice(n_artists, size = n_feat, p = artist_p) if x != main_artist]
+            tracks.append({
+                "id": track_ids[len(tracks)],
+                "name": f"Track {len(tracks)}",
+                "duration_ms": int(rng.integers(90_000, 420_000)),
+                "track_number": number,
+                "album": album,
+                "artists": [artists[i] for i in dict.fromkeys([main_artist] + feats)],
+            })
+
+    # 熱門度跟專輯順序無關
+    order = rng.permutation(n_tracks)
+    return [tracks[i] for i in order]
+
+
+def generate_plays(catalog: list, n: int, start, seed = 0, zipf_s = 1.1) -> pd.DataFrame:
+    """
+    從 catalog 依 Zipf 熱門度抽 n 次播放，回傳 parse_track 格式的 df
+    start: 第一首的 played_at (UTC)；之後每首間隔 = 上一首長度 + 0~5 分鐘，played_at 是遞增的 ISO 字串 (同 API)
+    """
+    rng = np.random.default_rng(seed)
+    picks = rng.choice(len(catalog), size = n, p = _zipf_p(len(catalog), zipf_s))
+    gaps = rng.integers(0, 300_000, size = n)
+    contexts = rng.choice(len(CONTEXT_TYPES), size = n, p = CONTEXT_P)
+
+    t = pd.Timestamp(start)
+    t = t.tz_localize("UTC") if t.tzinfo is None else t.tz_convert("UTC")
+    played_ms = int(t.value // 1_000_000)
+
+    rows = []
+    for pick, gap, ctx in zip(picks, gaps, contexts):
+        track = catalog[pick]
+        context_type = CONTEXT_TYPES[ctx]
+        item = {
+            "track": track,
+            "played_at": pd.Timestamp(played_ms, unit = "ms", tz = "UTC").strftime("%Y-%m-%dT%H:%M:%S.%f")[:-3] + "Z",
+            "context": {"type": context_type, "uri": f"spotify:{context_type}:{track['album']['id']}"} if context_type else None,
+        }
+        rows.append(parse_track(item))
+        played_ms += track["duration_ms"] + int(gap)
+
+    return pd.DataFrame(rows)
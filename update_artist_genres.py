@@ -1,4 +1,4 @@
-from spotify_log import db_utils, auth_code_flow
+from spotify_log import db_utils, auth_code_flow, enrich
 import pandas as pd, time
 from config import get_config
 
@@ -14,7 +14,7 @@ if not artists_list:
 
 start = time.time()
 tok = auth_code_flow.get_valid_token()
-genres_df = auth_code_flow.fetch_artist_genres(artists_list, tok)
+genres_df = enrich.fetch_artist_genres(artists_list, tok)
 print(f"取得需 artist 的 genres 資料: {time.time() - start:.2f}s")
 
 start = time.time()